@@ -9,25 +9,78 @@
 		    
 	Essentially a repository for the data of the chunk, and an inherited set of
 	routines (append, post, dump) for loading and outputting the data (Chunk class)
+
+	The data is kept in a bytearray, which grows in place - adding to
+	a string copied the whole track for every byte or two we appended.
+
+	A chunk can also be streamed: begin() writes the type and a dummy
+	length, then the data goes out to the file as it builds up, and 
+	post() goes back and fills in the real length.  Only a little of 
+	the chunk is ever held in memory.  If the file can't seek (a pipe)
+	the chunk is held and written in one go, as usual.
 """
 
+FLUSH_SIZE = 64 * 1024		# streaming: write out every 64K
+
 class Chunk():
+	outfile = None		# where we're streaming to, if we are
+	start = 0		# ... the file position of the chunk header
+	written = 0		# ... and how much data has gone out already
+
 	def __init__(self):
 		self.type = 'XXxx'
-		self.data = ''
+		self.data = bytearray()
 
 	def append(self, string):
 		self.data += string
+		if self.outfile is not None and len(self.data) >= FLUSH_SIZE:
+			self.flush()
+
+	def begin(self, outfile):
+		"""
+		Start streaming the chunk to a file, if the file can seek
+		back for the length.  Returns True if streaming.
+		"""
+		try:
+			if hasattr(outfile, 'seekable') and not outfile.seekable():
+				return False
+			self.start = outfile.tell()
+		except (IOError, AttributeError):
+			return False		# no seeking - hold the chunk, post writes it
+		outfile.write(self.type + word(0))	# real length filled in by post
+		self.outfile = outfile
+		self.written = 0
+		return True
+
+	def flush(self):
+		"""
+		Streaming: write what's built up so far
+		"""
+		self.outfile.write(self.data)
+		self.written += len(self.data)
+		self.data = bytearray()
+
+	def length(self):
+		"""
+		Length of the chunk data, streamed or not
+		"""
+		return self.written + len(self.data)
 
 	def post(self,outfile):
 		""" 
 		put the chunk to a file
 		"""
-		# simple: output the type, length and data...
-		outfile.write(self.type)
+		if self.outfile is not None:	# streaming: write the rest, patch the length
+			self.flush()
+			end = outfile.tell()
+			outfile.seek(self.start + 4)
+			outfile.write(word(self.written))
+			outfile.seek(end)
+			self.outfile = None
+			return
+		# simple: output the type, length and data... in one write
 		length=len(self.data)
-		outfile.write(word(length))
-		outfile.write(self.data)
+		outfile.write(self.type + word(length) + self.data)
 
 	def dump(self):
 		"""
@@ -43,7 +96,7 @@ class Chunk():
 		print "\nData:"
 		i=0
 		for c in self.data:
-			print " %02x" % ord(c),
+			print " %02x" % c,
 			i += 1
 			if i == 32:
 				print
@@ -59,7 +112,7 @@ class Header_Chunk(Chunk):
 	"""
 	def __init__(self):
 		self.type = 'MThd'
-		self.data = ''
+		self.data = bytearray()
 
 	def Init(self, fformat, tracks, ppq):
 		self.append(half(fformat))
@@ -70,16 +123,33 @@ class Track_Chunk(Chunk):
 	"""
 	deceptively simple.  each event types knows how to "emit" itself
 	into the track data list (a binary string)
+
+	Channel messages go through message(), which keeps track of the
+	last status byte: with running_status set, a status byte the same 
+	as the last one is left out.  Meta events (and sysex) cancel 
+	running status - they call no_status().
 	"""
 	def __init__(self):
 		self.type = 'MTrk'
 		self.name = "No Name"
 		self.track_num = 0
-		self.data = ''
-		self.tied = False	# is there a tie pending?
-		# create a table of note off events for each "note" (<128 86 should be enough..)
-		# We use these for tied notes...
-		self.noteoff_list = [ 'None' for i in range(128) ]	 
+		self.data = bytearray()
+		self.running_status = False	# leave out repeated status bytes?
+		self.status = None	# last status byte written
+
+	def message(self, status, data):
+		"""
+		A channel message: the status byte (an int) and its data bytes
+		(a string)
+		"""
+		if self.running_status and status == self.status:
+			self.append(data)
+		else:
+			self.append(chr(status) + data)
+			self.status = status
+
+	def no_status(self):
+		self.status = None
 
 	def end(self):
 		# add the track end..
@@ -89,7 +159,7 @@ class Track_Chunk(Chunk):
 		for c in [ 0xff, 0x2f, 0x00 ]:	# end of track..
 			self.append(chr(c))
 
-def vlq(value, mask=0x00):
+def encode_vlq(value):
 	"""  
 	Variable Length Quantity
 	Returns a binary string of 1 - 4 bytes
@@ -98,23 +168,64 @@ def vlq(value, mask=0x00):
 	indicates more data to come. Final byte
 	does not have high order bit set.
 
-	Yes: this one is a bit tricky.   Does work though.
+	Builds the string from the low order end, so no recursion:
+	the last byte goes in first, every byte in front of it gets
+	the high order bit.
 	"""
-	# Uses recursion to output the higher order bytes first.
+	if value < 0:
+		raise ValueError("Negative variable length quantity: %d" % value)
+	string = chr(value & 0x7f)	# last byte, no high bit
+	value >>= 7
+	while value:
+		string = chr((value & 0x7f) | 0x80) + string
+		value >>= 7
+	return(string)
 
-	string = ''	# what we'll eventually return, a binary string
-	if value < 0x80:
-		val = value | mask
-		if val not in range(256):
-			print "WHAT???", val
-		return(chr(val))
-	else:
-		string += vlq(value >> 7, 0x80)	# downshift 7 bits, call recursively
-		
-		val = (value & 0x7f) 	# fall through: call again with lower 7 bits, pass mask
-		string += vlq(val, mask)
+# Nearly every delta time fits in two bytes (0 - 16383), that's
+# 85 bars of 4/4 at 192 PPQ - so we build those once, up front.
+VLQ_TABLE_SIZE = 0x4000
+VLQ_TABLE = [ encode_vlq(n) for n in range(VLQ_TABLE_SIZE) ]
 
-	return(string)
+def vlq(value):
+	"""
+	Variable Length Quantity - straight from the table when
+	we can, computed when we can't
+	"""
+	if 0 <= value < VLQ_TABLE_SIZE:
+		return(VLQ_TABLE[value])
+	return(encode_vlq(value))
+
+def vlq_many(values):
+	"""
+	Encode a whole list of values (e.g. a track's delta times) in
+	one pass.  Returns a list of binary strings, one per value.
+	Nearly always they're all in the table, and it's one map().
+	"""
+	table = VLQ_TABLE
+	size = VLQ_TABLE_SIZE
+	if not isinstance(values, list):
+		values = list(values)
+	if values and min(values) >= 0:
+		try:
+			return(map(table.__getitem__, values))
+		except IndexError:	# one's past the table
+			pass
+	return([ table[v] if 0 <= v < size else encode_vlq(v) for v in values ])
+
+def unvlq(data, i=0):
+	"""
+	The reverse of vlq:  decode the variable length quantity
+	starting at data[i].  data is a bytearray (or anything else
+	that gives back integers).  Returns a tuple of the value and 
+	the index of the first byte past it.
+	"""
+	value = 0
+	while True:
+		b = data[i]
+		i += 1
+		value = (value << 7) | (b & 0x7f)
+		if b < 0x80:	# no high bit: last byte
+			return (value, i)
 
 def int2chars(val, count):
 	"""
@@ -150,12 +261,61 @@ def half(val):
 """
 Debug:
 """
+def check_vlq(samples=100000):
+	"""
+	Round trip the variable length quantities: every value in the
+	table, the edges of each byte length up to the full 28 bits, and
+	a random sample of the rest of the 28 bit range.
+	"""
+	import random
+
+	values = range(VLQ_TABLE_SIZE + 2)
+	for bits in 7, 14, 21, 28:
+		edge = 1 << bits
+		values += [ edge - 2, edge - 1, edge, edge + 1 ]
+	values += [ random.randint(0, 0x0fffffff) for n in range(samples) ]
+
+	if vlq_many(xrange(VLQ_TABLE_SIZE)) != VLQ_TABLE:	# (all in the table)
+		print "VLQ table lookups wrong"
+		return False
+	try:
+		vlq_many([ 1, -1 ])
+	except ValueError:
+		pass
+	else:
+		print "Negative VLQ taken"
+		return False
+
+	encoded = vlq_many(values)
+	for (value, string) in zip(values, encoded):
+		if string != vlq(value) or string != encode_vlq(value):
+			print "VLQ mismatch:", value, repr(string)
+			return False
+		if len(string) > 4 and value <= 0x0fffffff:
+			print "VLQ too long:", value, repr(string)
+			return False
+		if unvlq(bytearray(string)) != (value, len(string)):
+			print "VLQ round trip failed:", value, repr(string), unvlq(bytearray(string))
+			return False
+	# and a run of them back to back, as they'd be in a track..
+	data = bytearray(''.join(encoded))
+	i = 0
+	for value in values:
+		(v, i) = unvlq(data, i)
+		if v != value:
+			print "VLQ stream decode failed:", value, v
+			return False
+	print "VLQ round trip: %d values OK" % len(values)
+	return True
+
 def main():
+	check_vlq()
+
 	outfile = open('testout.mid','w')
 
 	print "Header:"
 	head_chunk = Header_Chunk()
-	head_chunk.Init(format=0, tracks=1, ppq=192)
+	head_chunk.Init(fformat=0, tracks=1, ppq=192)
 	head_chunk.dump()
 
 
@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+"""
+	Benchmarks for the uph -> MFF converter.
+
+	There's no .uph content on the repo, so we make up our own:
+	synth_score() builds a valid (if not very musical) score of
+	roughly the requested size, using most of the commands the
+	parser knows about: divisions, restarted measures, tuplets,
+	ties, groupings, accidentals, ramps, key changes and comments.
+
+	Run as a script to time the parser over scores from 10K up to
+	10M - the time per KB should stay flat if parsing is linear - 
+	and to get the raw parser throughput in characters per second.
+	The emit test pushes a million note events into one track chunk
+	and posts it.  The memory test gives the resident memory the parsed 
+	song takes, per event.  The parallel test parses the same score
+	on one core, then split across -j (see parallel.py).
+
+	With --phases, the conversion is timed a phase at a time instead:
+	reading the file, parsing, sorting the tracks, emitting them and
+	posting them to a file - seconds, events per second and peak 
+	memory for each.  --save writes that out as a JSON baseline; 
+	--baseline compares against one and fails (exit 1) if a phase got
+	slower, or bigger, by more than --tolerance:
+		bench.py --phases --save baseline.json
+		... change something ...
+		bench.py --phases --baseline baseline.json
+
+	-g writes a synthetic score to a file, for anything else to use.
+"""
+
+import sys
+import os
+import time
+import json
+import random
+import resource
+import tempfile
+import multiprocessing
+
+from optparse import OptionParser
+
+import parse
+import songevents
+import MFF
+import parallel
+
+NOTES = 'CDEFGAB'
+
+RUNS = { 1: 'Q', 2: 'I', 4: 'S', 8: 'T' }	# notes per beat -> duration
+
+def synth_measure(r, m, divisions, kinds=range(6), ties=True, density=None):
+	"""
+	One measure of 4/4 for one or more divisions, each division
+	restarting the measure with ';'.  kinds are the sorts of measure
+	to pick from (6 is a run of density notes per beat).
+	"""
+	out = []
+	for di, d in enumerate(divisions[:r.randint(1, len(divisions))]):
+		if di:
+			out.append('; ')
+		out.append(d + ' ')
+		kind = kinds[r.randint(0, len(kinds) - 1)]
+		if kind == 0:	# tuplet
+			out.append("'3 I C%d D E ' Q R R %s " % (r.randint(3,5), r.choice(NOTES)))
+		elif kind == 1 and ties:	# grouping and a tie
+			out.append('Q (C4 E G) I %s %s Q E & Q E ' % (r.choice(NOTES), r.choice(NOTES)))
+		elif kind == 1:		# ... just the grouping
+			out.append('Q (C4 E G) I %s %s H E ' % (r.choice(NOTES), r.choice(NOTES)))
+		elif kind == 2:	# accidentals, staccato
+			out.append('I #F4 G !A B %C5 Q ^D S E F ')
+		elif kind == 3:
+			out.append('W %s%d ' % (r.choice(NOTES), r.randint(2,6)))
+		elif kind == 4:	# dotted
+			out.append('Q. C4 I D H E ')
+		elif kind == 5:
+			out.append('Q R %s R %s ' % (r.choice(NOTES), r.choice(NOTES)))
+		else:		# a run
+			out.append('%s %s%d ' % (RUNS[density], r.choice(NOTES), r.randint(3,5)))
+			out.append(' '.join([ r.choice(NOTES) for n in range(4 * density - 1) ]) + ' ')
+	out.append('/\r\n')
+	return ''.join(out)
+
+def synth_score(size, seed=1, divisions='U:J*', density=None, tuplets=True, ties=True,
+		ramps=True, comments=True):
+	"""
+	Build a score of about size bytes.  Same seed, same score.
+	divisions are the ones to use (each measure uses some of them,
+	in order).  With density (notes per beat: 1, 2, 4 or 8) half the
+	measures are runs of notes that fast.  tuplets, ties, ramps 
+	(tempo and volume) and comments can each be left out.
+	"""
+	if density is not None and density not in RUNS:
+		raise ValueError("density must be one of %s" % sorted(RUNS.keys()))
+	r = random.Random(seed)
+	kinds = [ kind for kind in range(6) if tuplets or kind != 0 ]
+	if density is not None:
+		kinds += [ 6 ] * len(kinds)
+	out = [ ('"Synthetic score" ' if comments else '') + '$4-4 =120 U V40 K2# Q ' ]
+	length = len(out[0])
+	vol = 40
+	m = 0
+	while length < size:
+		if ramps and m % 16 == 5:	# tempo ramp
+			out.append('+4 =%d ' % r.choice([90, 120, 150]))
+		if ramps and m % 16 == 9:	# volume ramp - must change the volume
+			vol = r.choice([v for v in (20, 40, 60) if v != vol])
+			out.append('>2 V%d ' % vol)
+		if comments and m % 32 == 7:
+			out.append('"measure %d" ' % m)
+		if m % 40 == 20:
+			out.append('K%d%s ' % (r.choice([1,2,3]), r.choice('#!')))
+		out.append(synth_measure(r, m, divisions, kinds, ties, density))
+		length += len(out[-1])
+		m += 1
+	out.append('Z\n')
+	return ''.join(out)
+
+def new_song(ppq=192):
+	song = songevents.Song()
+	song.format = 1
+	song.PPQ = ppq
+	song.time_factor = 1
+	return song
+
+class Quiet():
+	"""
+	Keep the parser's chatter out of the timings
+	"""
+	def __enter__(self):
+		self.stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+
+	def __exit__(self, *args):
+		sys.stdout.close()
+		sys.stdout = self.stdout
+
+def time_parse(text):
+	"""
+	Write the score to a temp file and time parse_song on it.
+	Returns (seconds, song)
+	"""
+	(fd, filename) = tempfile.mkstemp(suffix='.uph')
+	os.write(fd, text)
+	os.close(fd)
+	try:
+		song = new_song()
+		with Quiet():
+			start = time.time()
+			parse.parse_song(filename, song)
+			elapsed = time.time() - start
+	finally:
+		os.remove(filename)
+	return (elapsed, song)
+
+def scaling(max_size):
+	"""
+	Parse time against score size - 10K, 100K, ... up to max_size
+	"""
+	print "%10s %10s %12s %8s" % ("Size", "Seconds", "uS per KB", "Ratio")
+	size = 10 * 1024
+	base = None
+	while size <= max_size:
+		text = synth_score(size)
+		(elapsed, song) = time_parse(text)
+		per_kb = elapsed * 1000000 / (len(text) / 1024.0)
+		if base is None:
+			base = per_kb
+		print "%10d %10.3f %12.1f %8.2f" % (len(text), elapsed, per_kb, per_kb / base)
+		size *= 10
+
+def throughput(size, runs=3):
+	"""
+	Characters per second through parse_song, best of a few runs
+	"""
+	text = synth_score(size)
+	best = None
+	for n in range(runs):
+		(elapsed, song) = time_parse(text)
+		if best is None or elapsed < best:
+			best = elapsed
+	print "%d chars in %.3f seconds: %.0f chars/second" % (len(text), best, len(text) / best)
+
+def emit_events(count):
+	"""
+	Emit count events (alternating note on / note off) into a single
+	track, then post it.
+	"""
+	track = MFF.Track_Chunk()
+	on = songevents.Note()
+	on.note_num = 60
+	off = songevents.NoteOff()
+	off.note_num = 60
+	start = time.time()
+	for n in xrange(count / 2):
+		track.append(MFF.vlq(0))
+		on.emit(track)
+		track.append(MFF.vlq(191))
+		off.emit(track)
+	track.end()
+	emitted = time.time()
+	outfile = open(os.devnull, 'wb')
+	track.post(outfile)
+	outfile.close()
+	done = time.time()
+	print "%d events, %d bytes: emit %.3f seconds (%.0f events/second), post %.3f seconds" % (
+		count, len(track.data), emitted - start, count / (emitted - start), done - emitted)
+
+def rss():
+	"""
+	Resident set size of this process, in bytes (Linux only)
+	"""
+	statm = open('/proc/self/statm').read().split()
+	return int(statm[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def event_memory(size):
+	"""
+	How much memory a parsed song holds on to, per event
+	"""
+	text = synth_score(size)
+	before = rss()
+	(elapsed, song) = time_parse(text)
+	after = rss()
+	events = sum([ len(events) for events in song.track_events ])
+	print "%d events: %d bytes, %.1f bytes per event" % (events, after - before, float(after - before) / events)
+
+def parallel_speedup(size, jobs, runs=3):
+	"""
+	Parse time on one core against the score split across jobs worker
+	processes (best of a few runs each).  Only as good as the number
+	of cores really free.
+	"""
+	text = parse.read_score(synth_score(size))
+	times = []
+	for j in 1, jobs:
+		best = None
+		for n in range(runs):
+			song = new_song()
+			with Quiet():
+				start = time.time()
+				if j == 1:
+					parse.parse_text(text, song)
+				else:
+					parallel.parse_parallel(text, song, j)
+				elapsed = time.time() - start
+			if best is None or elapsed < best:
+				best = elapsed
+		times.append(best)
+	print "%d chars: 1 job %.3f seconds, %d jobs %.3f seconds - speedup %.2f (%d CPUs)" % (
+		len(text), times[0], jobs, times[1], times[0] / times[1], multiprocessing.cpu_count())
+
+PHASES = ( 'read', 'parse', 'sort', 'emit', 'post' )
+NOISE = 0.01	# seconds: a phase this much slower (or less) hasn't regressed
+
+def reset_peak():
+	"""
+	Start measuring peak memory again (Linux can reset the "high
+	water mark").  False if it can't be done here.
+	"""
+	try:
+		clear = open('/proc/self/clear_refs', 'w')
+		clear.write('5')
+		clear.close()
+	except IOError:
+		return False
+	return True
+
+def peak():
+	"""
+	Peak resident memory, in bytes, since reset_peak() - or since we
+	started, where that can't be reset
+	"""
+	try:
+		for line in open('/proc/self/status'):
+			if line.startswith('VmHWM:'):
+				return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024	# (KB on Linux)
+
+def time_phases(filename):
+	"""
+	Convert a score a phase at a time.  Returns the number of events
+	and { phase: (seconds, peak memory) }
+	"""
+	times = {}
+	def start():
+		reset_peak()
+		return time.time()
+	def done(phase, started):
+		times[phase] = (time.time() - started, peak())
+
+	t = start()
+	infile = open(filename, 'rb')
+	text = parse.read_score(infile)
+	infile.close()
+	done('read', t)
+
+	song = new_song()
+	t = start()
+	with Quiet():
+		parse.parse_text(text, song)
+	done('parse', t)
+	del text
+
+	t = start()
+	rows = [ song.sort_track(n) for n in range(song.track_count) ]
+	done('sort', t)
+
+	t = start()
+	chunks = []
+	for n in range(song.track_count):
+		chunks.append(song.emit_track(n, None, rows[n]))
+		chunks[-1].end()
+	done('emit', t)
+	del rows
+
+	(fd, out_name) = tempfile.mkstemp(suffix='.mid')
+	os.close(fd)
+	try:
+		t = start()
+		outfile = open(out_name, 'wb')
+		head = MFF.Header_Chunk()
+		head.Init(fformat=song.format, tracks=song.track_count, ppq=song.PPQ)
+		head.post(outfile)
+		for chunk in chunks:
+			chunk.post(outfile)
+		outfile.close()
+		done('post', t)
+	finally:
+		os.remove(out_name)
+	return (sum([ len(store) for store in song.track_events ]), times)
+
+def phase_bench(text, runs=3):
+	"""
+	Time the phases on a score, best of runs.  Memory is from the first
+	run (later ones start with what Python kept from the one before).
+	Returns the results, ready to save as a baseline.
+	"""
+	(fd, filename) = tempfile.mkstemp(suffix='.uph')
+	os.write(fd, text)
+	os.close(fd)
+	best = {}
+	try:
+		for n in range(runs):
+			(events, times) = time_phases(filename)
+			for (phase, (seconds, memory)) in times.items():
+				if phase not in best:
+					best[phase] = (seconds, memory)
+				elif seconds < best[phase][0]:
+					best[phase] = (seconds, best[phase][1])
+	finally:
+		os.remove(filename)
+	phases = {}
+	for phase in PHASES:
+		(seconds, memory) = best[phase]
+		phases[phase] = { 'seconds': seconds, 'events_per_second': events / seconds if seconds else 0,
+			'peak_bytes': memory }
+	return { 'chars': len(text), 'events': events, 'runs': runs,
+		'python': sys.version.split()[0], 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 
+		'phases': phases }
+
+def report_phases(results, baseline=None, tolerance=0.10):
+	"""
+	Print the phase times - against the baseline if there is one.
+	Returns the number of phases that got worse by more than tolerance.
+	"""
+	print "%d chars, %d events (best of %d):" % (results['chars'], results['events'], results['runs'])
+	if baseline is not None and (baseline['chars'], baseline['events']) != (results['chars'], results['events']):
+		print "Warning: the baseline was a different score: %d chars, %d events" % (baseline['chars'], baseline['events'])
+	worse = 0
+	heading = "%-8s %10s %14s %10s" % ("Phase", "Seconds", "Events/second", "Peak MB")
+	if baseline is not None:
+		heading += " %10s %10s" % ("Time", "Memory")
+	print heading
+	for phase in PHASES:
+		now = results['phases'][phase]
+		print "%-8s %10.3f %14.0f %10.1f" % (phase, now['seconds'], now['events_per_second'], 
+			now['peak_bytes'] / 1048576.0),
+		if baseline is None:
+			print
+			continue
+		then = baseline['phases'][phase]
+		time_ratio = now['seconds'] / then['seconds'] if then['seconds'] else 1
+		memory_ratio = float(now['peak_bytes']) / then['peak_bytes'] if then['peak_bytes'] else 1
+		flags = []
+		if time_ratio > 1 + tolerance and now['seconds'] - then['seconds'] > NOISE:
+			flags.append('SLOWER')
+		if memory_ratio > 1 + tolerance:
+			flags.append('BIGGER')
+		print "%9.2fx %9.2fx %s" % (time_ratio, memory_ratio, ' '.join(flags))
+		if flags:
+			worse += 1
+	return worse
+
+def getoptions():
+	parser = OptionParser()
+	parser.add_option("-m", "--max-size", dest="max_size", action="store",
+	type="int", metavar="Bytes", help="largest score to time [10M]", default=10 * 1024 * 1024)
+
+	parser.add_option("-e", "--events", dest="events", action="store",
+	type="int", metavar="Count", help="events per track for the emit test [1M]", default=1000000)
+
+	parser.add_option("-s", "--size", dest="size", action="store",
+	type="int", metavar="Bytes", help="score size for the throughput test [1M]", default=1024 * 1024)
+
+	parser.add_option("-j", "--jobs", dest="jobs", action="store",
+	type="int", metavar="N", help="worker processes for the parallel test [one per CPU]", 
+	default=multiprocessing.cpu_count())
+
+	parser.add_option("-P", "--parallel-size", dest="parallel_size", action="store",
+	type="int", metavar="Bytes", help="score size for the parallel test [4M]", default=4 * 1024 * 1024)
+
+	parser.add_option("--phases", dest="phases", action="store_true",
+	help="time each phase of a conversion (of a score of --size)", default=False)
+
+	parser.add_option("--runs", dest="runs", action="store",
+	type="int", metavar="N", help="phases: best of N runs [3]", default=3)
+
+	parser.add_option("--save", dest="save", action="store",
+	type="string", metavar="File", help="phases: write the results as a JSON baseline", default=None)
+
+	parser.add_option("--baseline", dest="baseline", action="store",
+	type="string", metavar="File", help="phases: compare with a saved baseline", default=None)
+
+	parser.add_option("--tolerance", dest="tolerance", action="store",
+	type="float", metavar="Percent", help="phases: how much worse is a regression [10]", default=10)
+
+	parser.add_option("-g", "--generate", dest="generate", action="store",
+	type="string", metavar="File", help="just write a synthetic score of --size to File", default=None)
+
+	parser.add_option("--seed", dest="seed", action="store",
+	type="int", metavar="N", help="synthetic score: random seed [1]", default=1)
+
+	parser.add_option("--divisions", dest="divisions", action="store",
+	type="string", metavar="Chars", help="synthetic score: divisions to use [U:J*]", default='U:J*')
+
+	parser.add_option("--density", dest="density", action="store",
+	type="choice", choices=[ str(n) for n in sorted(RUNS.keys()) ], metavar="N", 
+	help="synthetic score: runs of N notes per beat (1, 2, 4, 8) [none]", default=None)
+
+	for feature in 'tuplets', 'ties', 'ramps', 'comments':
+		parser.add_option("--no-" + feature, dest=feature, action="store_false",
+		help="synthetic score: no %s" % feature, default=True)
+
+	(options, args) = parser.parse_args()
+	return (options, args)
+
+def main():
+	(options, args) = getoptions()
+	if options.generate or options.phases or options.save or options.baseline:
+		text = synth_score(options.size, options.seed, options.divisions,
+			None if options.density is None else int(options.density),
+			options.tuplets, options.ties, options.ramps, options.comments)
+		if options.generate:
+			outfile = open(options.generate, 'wb')
+			outfile.write(text)
+			outfile.close()
+			print "Wrote %d chars to %s" % (len(text), options.generate)
+			return
+		results = phase_bench(text, options.runs)
+		baseline = None
+		if options.baseline:
+			infile = open(options.baseline)
+			baseline = json.load(infile)
+			infile.close()
+		worse = report_phases(results, baseline, options.tolerance / 100.0)
+		if options.save:
+			outfile = open(options.save, 'w')
+			json.dump(results, outfile, indent=1, sort_keys=True)
+			outfile.close()
+			print "Baseline saved:", options.save
+		if worse:
+			print "%d phase(s) worse than the baseline" % worse
+			sys.exit(1)
+		return
+
+	print "Parse throughput:"
+	throughput(options.size)
+	print "Event memory:"
+	event_memory(options.size)
+	print "Track emit:"
+	emit_events(options.events)
+	print "Parallel parse:"
+	parallel_speedup(options.parallel_size, max(2, options.jobs))
+	print "Parse scaling:"
+	scaling(options.max_size)
+
+
+if __name__ == "__main__":
+	main()
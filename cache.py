@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+	An on-disk cache of converted songs.  The same .uph, converted
+	the same way, always comes out the same - so once it's been done
+	we keep the MIDI and hand it back next time without parsing at all.
+
+	Each entry is named for a hash of the score's bytes, the settings
+	it was converted with (PPQ, correction, format...) and the
+	converter version.  Change any of them and it's a different entry;
+	nothing ever needs to be invalidated.  Bump CONVERTER_VERSION
+	when a change to the converter changes its output.
+
+	Entries are plain files, two levels down (ab/abcdef...mid), so
+	several processes can share a cache: each entry is written to a
+	temporary file and renamed into place.  When the cache grows past
+	its size limit the least recently used entries go (a hit touches
+	the file, so the modification time is the last use) - down to
+	LOW_WATER of the limit, so the directory is only gone through
+	again once a good few more have been added, not on every one.
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+
+CONVERTER_VERSION = '1'		# bump when the output for the same input changes
+DEFAULT_SIZE = 256 * 1024 * 1024	# bytes
+LOW_WATER = 0.8		# evicting takes the cache down to this much of its limit
+SUFFIX = '.mid'
+
+class Cache():
+	def __init__(self, directory, max_size=DEFAULT_SIZE):
+		self.directory = directory
+		self.max_size = max_size
+		self.size = None	# bytes in the cache - worked out when first needed
+		self.hits = 0
+		self.misses = 0
+		self.evicted = 0
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:		# someone else just made it
+				if not os.path.isdir(directory):
+					raise
+
+	def key(self, data, settings):
+		"""
+		The key for a score (its bytes) converted with the given
+		settings (a dictionary)
+		"""
+		h = hashlib.sha1()
+		h.update(CONVERTER_VERSION + '\0')
+		h.update(repr(sorted(settings.items())) + '\0')
+		h.update(data)
+		return h.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + SUFFIX)
+
+	def get(self, key):
+		"""
+		The MIDI stored under key, or None
+		"""
+		path = self.path(key)
+		try:
+			infile = open(path, 'rb')
+		except IOError:
+			self.misses += 1
+			return None
+		midi = infile.read()
+		infile.close()
+		try:
+			os.utime(path, None)	# just used
+		except OSError:		# evicted by someone else meanwhile - we've got it anyway
+			pass
+		self.hits += 1
+		return midi
+
+	def put(self, key, midi):
+		"""
+		Store the MIDI under key, then make room if need be.  Anything
+		bigger than the whole cache isn't kept.
+		"""
+		if len(midi) > self.max_size:
+			return
+		path = self.path(key)
+		directory = os.path.dirname(path)
+		if not os.path.isdir(directory):
+			try:
+				os.mkdir(directory)
+			except OSError:
+				if not os.path.isdir(directory):
+					raise
+		(fd, temp) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+		try:
+			os.write(fd, midi)
+		finally:
+			os.close(fd)
+		try:
+			replaced = os.stat(path).st_size	# (someone else got here first)
+		except OSError:
+			replaced = 0
+		os.rename(temp, path)	# all or nothing, as far as anyone else can tell
+
+		if self.size is None:
+			self.size = self.total()
+		else:
+			self.size += len(midi) - replaced
+		if self.size > self.max_size:
+			self.evict()
+
+	def entries(self):
+		"""
+		(modification time, size, path) for everything in the cache
+		"""
+		entries = []
+		for (dirpath, dirnames, filenames) in os.walk(self.directory):
+			for name in filenames:
+				if not name.endswith(SUFFIX):
+					continue
+				path = os.path.join(dirpath, name)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+		return entries
+
+	def total(self):
+		return sum([ size for (mtime, size, path) in self.entries() ])
+
+	def evict(self):
+		"""
+		Take out the least recently used entries until we're down to
+		LOW_WATER of the limit.  (Other processes may be adding too, so
+		the directory is counted again, rather than trusting our total.)
+		"""
+		entries = sorted(self.entries())
+		size = sum([ size for (mtime, size, path) in entries ])
+		low = int(self.max_size * LOW_WATER)
+		for (mtime, length, path) in entries:
+			if size <= low:
+				break
+			try:
+				os.remove(path)
+			except OSError:		# someone else got it first
+				pass
+			else:
+				self.evicted += 1
+			size -= length
+		self.size = size
+
+	def report(self):
+		print "Cache: %d hits, %d misses, %d evicted" % (self.hits, self.misses, self.evicted)
+
+"""
+Debug:
+"""
+def main():
+	import shutil
+	directory = tempfile.mkdtemp()
+	try:
+		cache = Cache(directory, max_size=250)
+		settings = { 'ppq': 192, 'time_factor': 1 }
+		k1 = cache.key('score one', settings)
+		k2 = cache.key('score one', { 'ppq': 480, 'time_factor': 1 })
+		if k1 == k2:
+			print "Different settings, same key"
+		if cache.get(k1) is not None:
+			print "Hit on an empty cache"
+		cache.put(k1, 'x' * 100)
+		if cache.get(k1) != 'x' * 100:
+			print "Stored entry didn't come back"
+		old = time.time() - 60
+		os.utime(cache.path(k1), (old, old))	# k1 used a minute ago...
+		cache.put(k2, 'y' * 100)
+		cache.get(k1)				# ... and again just now
+		k3 = cache.key('score three', settings)
+		cache.put(k3, 'z' * 100)		# over the limit: k2's the oldest
+		if cache.get(k2) is not None or cache.get(k1) is None or cache.get(k3) is None:
+			print "Eviction took the wrong entry"
+		cache.put(cache.key('score four', settings), 'w' * 40)	# room for it: nothing goes
+		cache.put(k3, 'z' * 100)		# the same again: no bigger
+		if cache.size != cache.total() or cache.size != 240:
+			print "Cache size wrong:", cache.size, cache.total()
+		cache.report()
+		if (cache.hits, cache.misses, cache.evicted) != (4, 2, 1):
+			print "Cache stats wrong"
+		else:
+			print "Cache OK"
+	finally:
+		shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	main()
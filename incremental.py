@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""
+	Re-parsing an edited score without starting over.
+
+	A Score parses the text once, keeping a Checkpoint of the parser at
+	every barline.  When the text changes (edit()), the parse picks up
+	again from the last checkpoint before the first change, and runs
+	until it reaches a barline in the unchanged end of the text where
+	its state matches what the old parse had there.  From there on the
+	old parse's events are still good: they're spliced on after the
+	new ones, and the rest of the text isn't looked at.
+
+	What makes it more than a restart is ties.  A tie moves the end of
+	an earlier note, which can be anywhere before it - so each
+	checkpoint keeps the ties of its measure, and the note-offs its
+	measure left behind for ties later on.  When re-parsing, the ties
+	the old parse made after the restart point are taken back off
+	the rows before it; when splicing, the ones made in the old end of
+	the text go back on - onto the matching new rows where the notes
+	they tied were re-parsed.  The state only matches if the same tie
+	slots were re-filled in both parses.  The measure the text ends in
+	(no barline after it) has its ties kept the same way, in the
+	score's tail checkpoint.
+
+	A change that moves the timing of the rest of the song (a measure
+	gets longer, a barline is added...) never matches up, and the parse
+	runs to the end - as slow as parsing it from scratch, no slower.
+	Emitting the MIDI is still done for the whole song.
+"""
+
+import copy
+import time
+from bisect import bisect_right
+
+import parse
+import songevents
+
+CHUNK = 4096	# for comparing the old and new text
+
+def common_prefix(a, b):
+	"""
+	How many characters a and b start with in common
+	"""
+	n = min(len(a), len(b))
+	i = 0
+	while i < n and a[i:i + CHUNK] == b[i:i + CHUNK]:
+		i += CHUNK
+	end = min(i + CHUNK, n)
+	while i < end and a[i] == b[i]:
+		i += 1
+	return i
+
+def common_suffix(a, b, limit):
+	"""
+	How many characters a and b end with in common (no more than limit)
+	"""
+	i = 0
+	la = len(a)
+	lb = len(b)
+	while i + CHUNK <= limit and a[la - i - CHUNK:la - i] == b[lb - i - CHUNK:lb - i]:
+		i += CHUNK
+	while i < limit and a[la - i - 1] == b[lb - i - 1]:
+		i += 1
+	return i
+
+class Slots():
+	"""
+	A track's note-offs left for ties, for a parse picked up from a
+	checkpoint: rather than working out all 128 up front, each one is
+	looked up (back through the checkpoints) the first time it's used.
+	Ties are rare, so that's not often.
+	"""
+	def __init__(self, score, track_num, store, last):
+		self.score = score
+		self.track_num = track_num
+		self.store = store
+		self.last = last	# the checkpoint we started from
+		self.found = {}
+		self.written = {}	# slot -> note-off, set since the restart
+
+	def __getitem__(self, slot):
+		if slot in self.written:
+			return self.written[slot]
+		if slot not in self.found:
+			self.found[slot] = 'None'
+			key = (self.track_num, slot)
+			for n in xrange(self.last, -1, -1):
+				cp = self.score.checkpoints[n]
+				if key in cp.notes:
+					row = cp.rows[self.track_num] + cp.notes[key]
+					self.found[slot] = songevents.NoteView(self.store, row)
+					break
+		return self.found[slot]
+
+	def __setitem__(self, slot, noteoff):
+		self.written[slot] = noteoff
+
+def written(slots):
+	"""
+	slot -> row for the note-offs set since the restart
+	"""
+	if isinstance(slots, Slots):
+		return dict([ (slot, view.row) for (slot, view) in slots.written.items() ])
+	return dict([ (slot, view.row) for (slot, view) in enumerate(slots) if view != 'None' ])
+
+def empty_copy(song):
+	"""
+	A new song with the same settings, no tracks
+	"""
+	song = copy.copy(song)
+	song.track_list = []
+	song.track_events = []
+	song.track_count = 0
+	return song
+
+class Score():
+	"""
+	A parsed score that can be edited.  song is a new, empty (but set
+	up) Song; it's parsed into, and replaced by a new one on each edit
+	(the old one is left as it was).
+	"""
+	def __init__(self, text, song):
+		self.text = text
+		self.template = empty_copy(song)	# the settings, for new songs
+		self.song = song
+		self.checkpoints = []
+		parser = parse.Parser(song, self.checkpoints)
+		parser.parse(text)
+		self.finish(parser)
+
+	def finish(self, parser):
+		"""
+		After a parse that ran to the end: the final state, and the
+		index to find the checkpoints by
+		"""
+		self.ended = parser.ended
+		self.position = parser.position
+		self.measure_num = parser.measure_num
+		self.index = [ cp.i for cp in self.checkpoints ]
+		self.tail = parse.Checkpoint(parser)	# the ties after the last barline (not in the index)
+
+	def report(self):
+		"""
+		What parse_song would have said at the end
+		"""
+		if not self.ended:
+			print "Warning: file likely not properly terminated."
+		print "Final position:", self.position
+		print "Measures:", self.measure_num
+
+	def edit(self, text):
+		"""
+		The text has changed: bring the song up to date.  Returns
+		(measures re-parsed, True if the old parse was picked up again)
+		"""
+		old = self.text
+		same = common_prefix(old, text)
+		if same == len(old) == len(text):
+			return (0, True)
+		tail = common_suffix(old, text, min(len(old), len(text)) - same)
+		start = bisect_right(self.index, same) - 1	# last checkpoint before the change
+
+		if start < 0:	# changed in the first measure - start again
+			self.__init__(text, empty_copy(self.template))
+			return (len(self.checkpoints), False)
+		return Reparse(self, start, text, len(text) - len(old), len(text) - tail).run()
+
+class Reparse():
+	"""
+	One edit: picks up from checkpoint start.  The text is shift
+	characters longer than it was, and the same as it was from 
+	tail_from on.
+	"""
+	def __init__(self, score, start, text, shift, tail_from):
+		self.score = score
+		self.start = start
+		self.text = text
+		self.shift = shift
+		self.tail_from = tail_from	# new checkpoints from here on may match
+		self.old_song = score.song
+		self.later = score.checkpoints + [ score.tail ]	# every old checkpoint's ties
+		self.new = []		# checkpoints of the re-parse
+		self.matched = False
+
+	def run(self):
+		score = self.score
+		old_cps = score.checkpoints
+		later_cps = self.later
+		cp = old_cps[self.start]
+		old = self.old_song
+
+		# the song as it was at the checkpoint...
+		song = empty_copy(score.template)
+		tracks = len(cp.rows)
+		song.track_list = old.track_list[:tracks]
+		song.track_count = tracks
+		song.track_events = [ old.track_events[t].head(cp.rows[t]) for t in range(tracks) ]
+
+		# ... less what later ties did to it.  Ties that reach back
+		# past their own measure are kept to be put back on the splice.
+		self.far = []	# (checkpoint number, which of its ties, track, old row, pulses)
+		before = cp.rows
+		for n in xrange(self.start + 1, len(later_cps)):
+			later = later_cps[n]
+			for (k, (t, rel, pulses)) in enumerate(later.ties):
+				row = later.rows[t] + rel
+				if t < len(before) and row < before[t]:
+					song.track_events[t].pos[row] -= pulses
+				if t >= len(later_cps[n - 1].rows) or row < later_cps[n - 1].rows[t]:
+					self.far.append((n, k, t, row, pulses))
+
+		parser = parse.Parser(song, self.new, resume=cp)
+		parser.noteoff_list = [ Slots(score, t, song.track_events[t], self.start) for t in range(tracks) ]
+		parser.on_checkpoint = self.check
+		self.song = song
+		self.parser = parser
+		self.next_old = self.start + 1	# the old checkpoints looked at so far...
+		self.old_written = {}		# ... and the note-offs they left: (track, slot) -> old row
+		parser.parse(self.text)
+
+		if self.matched:	# (the tail is the old one, moved)
+			score.song = song
+			score.checkpoints = old_cps[:self.start + 1] + self.new + old_cps[self.match + 1:]
+			score.index = [ c.i for c in score.checkpoints ]
+		else:
+			score.song = song
+			score.checkpoints = old_cps[:self.start + 1] + self.new
+			score.finish(parser)
+		score.text = self.text
+		return (len(self.new), self.matched)
+
+	def check(self, cp):
+		"""
+		A new checkpoint: does it match the old parse here?  If so,
+		splice the rest of the old song on and stop.
+		"""
+		if cp.i < self.tail_from:
+			return False
+		score = self.score
+		old_cps = score.checkpoints
+		n = bisect_right(score.index, cp.i - self.shift) - 1
+		if n < self.next_old or score.index[n] != cp.i - self.shift:
+			return False
+		old_cp = old_cps[n]
+		if old_cp.state != cp.state or len(old_cp.rows) != len(cp.rows):
+			return False
+
+		# the note-offs left for ties have to be the same ones -
+		# re-filled in both parses (-> a map from old rows to new),
+		# or not touched in either
+		for m in xrange(self.next_old, n + 1):
+			c = old_cps[m]
+			for ((t, slot), rel) in c.notes.items():
+				self.old_written[(t, slot)] = c.rows[t] + rel
+		self.next_old = n + 1
+		new_written = {}
+		for (t, slots) in enumerate(self.parser.noteoff_list):
+			for (slot, row) in written(slots).items():
+				new_written[(t, slot)] = row
+		if set(new_written.keys()) != set(self.old_written.keys()):
+			return False
+		rows = {}	# (track, old row) -> new row
+		for (key, row) in self.old_written.items():
+			rows[(key[0], row)] = new_written[key]
+
+		# the old ties from here on that reach back before here
+		start = old_cps[self.start].rows
+		moved = []	# (checkpoint number, which of its ties, track, new row, pulses)
+		for (m, k, t, row, pulses) in self.far:
+			if m <= n or t >= len(old_cp.rows) or row >= old_cp.rows[t]:
+				continue
+			if t < len(start) and row < start[t]:
+				new_row = row
+			elif (t, row) in rows:
+				new_row = rows[(t, row)]
+			else:
+				return False	# tied to a note that's not there any more
+			moved.append((m, k, t, new_row, pulses))
+
+		# it matches: splice
+		song = self.song
+		old = self.old_song
+		for t in range(len(cp.rows)):
+			song.track_events[t].extend(old.track_events[t], old_cp.rows[t])
+		for t in range(len(cp.rows), len(old.track_events)):	# tracks added later on
+			song.track_list.append(old.track_list[t])
+			song.track_events.append(old.track_events[t].head(len(old.track_events[t])))
+		song.track_count = len(song.track_list)
+		for (m, k, t, new_row, pulses) in moved:
+			song.track_events[t].pos[new_row] += pulses
+
+		# the old checkpoints from here on (and the tail): the text and rows have moved
+		later_cps = self.later
+		drows = [ cp.rows[t] - old_cp.rows[t] for t in range(len(cp.rows)) ]
+		shift = self.shift
+		if shift or [ d for d in drows if d ]:
+			for m in xrange(n + 1, len(later_cps)):
+				c = later_cps[m]
+				c.i += shift
+				c.rows = tuple([ r + (drows[t] if t < len(drows) else 0) for (t, r) in enumerate(c.rows) ])
+		for (m, k, t, new_row, pulses) in moved:	# ... and these ties now reach somewhere else
+			c = later_cps[m]
+			c.ties[k] = (t, new_row - c.rows[t], pulses)
+		self.match = n
+		self.matched = True
+		return True
+
+"""
+Debug:
+"""
+def new_song():
+	song = songevents.Song()
+	song.format = 1
+	song.PPQ = 192
+	song.time_factor = 1
+	return song
+
+def render(song):
+	import io
+	outfile = io.BytesIO()
+	song.create_MFF(outfile, None)
+	return outfile.getvalue()
+
+def check_edits(size, edits, seed=1):
+	"""
+	Make random edits to a synthetic score: after each one, the
+	edited song has to come out the same as a fresh parse would.
+	"""
+	import random
+	import bench
+	r = random.Random(seed)
+	text = parse.read_score(bench.synth_score(size, seed))
+	with bench.Quiet():
+		score = Score(text, new_song())
+	changes = [ ('C', 'D'), ('E', 'G'), ('Q', 'I'), ('I', 'S'), ('#', '!'), 
+		(' ', ' & '), ('&', ' '), ('/', ' '), (' ', ' / '), ('G', 'G4') ]
+	worst = 0
+	for n in range(edits):
+		(old, new) = r.choice(changes)
+		at = text.find(old, r.randint(0, len(text) - 1))
+		if at < 0:
+			continue
+		text = text[:at] + new + text[at + len(old):]
+		with bench.Quiet():
+			start = time.time()
+			(measures, matched) = score.edit(text)
+			elapsed = time.time() - start
+			fresh = new_song()
+			parse.Parser(fresh).parse(text)
+			same = render(score.song) == render(fresh)
+		if not same:
+			print "Edit", n, repr(old), "->", repr(new), "at", at, "came out different (seed %d)" % seed
+			return False
+		if matched:
+			worst = max(worst, elapsed)
+	print "%d edits OK, slowest matched re-parse %.1f mS (seed %d)" % (edits, worst * 1000, seed)
+	return True
+
+def main():
+	for seed in range(1, 5):
+		if not check_edits(8000, 150, seed):
+			return
+
+
+if __name__ == "__main__":
+	main()
@@ -4,119 +4,161 @@
 	accidentals
 """
 
+# natural offset of each note... (0-6) -> (0-12)
+NOTE_OFFSET=[ 0, 2, 4, 5, 7, 9, 11 ] 
+
+# Notes are indexed octave * 12 + note (0-6) - the same index
+# is used for the accidentals and the pitch tables
+TABLE_SIZE = 128
+
+KEY_MASTER = [ 
+	0,	# 0 C, no #/b   
+	3,	# +1 G:  F -> F3  
+	0,	# +2 D:  C -> C#  
+	4,	# +3 A:  G -> G#  
+	1,	# +4 E:  D -> D#  
+	5,	# +5 B:  A -> A#  
+	2,	# +6 F#: E -> E# (F)  
+	6,	# +7 C#: B -> B# (C)  
+
+	3,	# -7 Cb: F -> Fb (E)  
+	0,	# -6 Gb: C -> Cb (B)  
+	4,	# -5 Db: G -> Gb  
+	1,	# -4 Ab: D -> Db  
+	5,	# -3 Eb: A -> Ab  
+	2,	# -2 Bb: E -> Eb  
+	6,	# -1 F:  B -> Bb  
+	]
+
+MIN_KEY = -9
+MAX_KEY = 9
+
+def build_key_table(key):
+	"""
+	A little tricky:  key is in the range -7 to 7, with 0
+	being C major / A minor - no sharps or flats.  Positive values
+	are sharp keys, negative value are flat.  Flat keys are 
+	reverse indexed from the end.  Setting the key table then
+	consists of zeroing the 7 note entries, then putting the -1 or 
+	+1 adjustment into the proper spots - indexing up or down until
+	we get to C (0).
+
+	Has the added feature that bizarre keys like 8 or 9 
+	sharps or flats actually work
+	"""
+	key_table = [ 0 for n in range(7) ]
+	if key == 0:
+		return key_table
+
+	sign = key / abs(key)	# +1 or -1
+
+	for i in range(key, 0, -sign):
+		key_table[KEY_MASTER[i]] = sign
+	return key_table
+
+def build_pitch_table(key_table):
+	"""
+	MIDI note number for every octave * 12 + note index, in one key
+	"""
+	pitches = [ 0 for n in range(TABLE_SIZE) ]
+	for octave in range(TABLE_SIZE / 12 + 1):
+		for note in range(7):
+			index = octave * 12 + note
+			if index < TABLE_SIZE:
+				pitches[index] = NOTE_OFFSET[note] + octave * 12 + key_table[note]
+	return pitches
+
+# All the keys we support (-9 - 9), built once: the adjustment for each
+# note of the scale, and the pitch of each note in every octave
+KEY_TABLES = {}
+PITCH_TABLES = {}
+for k in range(MIN_KEY, MAX_KEY + 1):
+	KEY_TABLES[k] = build_key_table(k)
+	PITCH_TABLES[k] = build_pitch_table(KEY_TABLES[k])
+NATURAL_PITCHES = PITCH_TABLES[0]	# no key adjustment at all
+
 class Key():
 	"""
 	Class to store and process key information.  Typically
-	part of a song.  Adjust routines are called when a note
-	is added to a song.
+	part of a song.  Adjust is called once for each note, when
+	it's created - its note-off shares the note number.
+
+	Accidentals only last to the end of the measure, so rather than
+	clearing a table at every barline, each accidental is stamped 
+	with the generation it was set in.  A reset just starts a new 
+	generation; anything stamped with an older one doesn't count.
 	"""
 	def __init__(self):
-		self.reset_accidentals()
+		self.accidentals = [ 0 for n in range(TABLE_SIZE) ]
+		self.acc_generation = [ -1 for n in range(TABLE_SIZE) ]
+		self.generation = 0
 		self.key_signature = 0
 		self.set_key(0)
-		# natural offset of each note... (0-6) -> (0-12)
-		self.NOTE_OFFSET=[ 0, 2, 4, 5, 7, 9, 11 ] 
+		self.NOTE_OFFSET = NOTE_OFFSET
 
 	def reset_accidentals(self):
 		"""
 		resets all of the accidentals, called at the end of each measure
 		"""
-		self.accidentals = [ 'None' for n in range(128) ]
+		self.generation += 1
 		#print "accidentals reset"
 	
 	def set_key(self, key):
 		"""
-		A little tricky:  key is in the range -7 to 7, with 0
-		being C major / A minor - no sharps or flats.  Positive values
-		are sharp keys, negative value are flat.  Flat keys are 
-		reverse indexed from the end.  Setting the key table then
-		consists of zeroing the 7 note entries, then putting the -1 or 
-		+1 adjustment into the proper spots - indexing up or down until
-		we get to C (0).
-
-		Has the added feature that bizarre keys like 8 or 9 
-		sharps or flats actually work
+		Set the key via the (prebuilt) table
 		"""
-		key_master = [ 
-			0,	# 0 C, no #/b   
-			3,	# +1 G:  F -> F3  
-			0,	# +2 D:  C -> C#  
-			4,	# +3 A:  G -> G#  
-			1,	# +4 E:  D -> D#  
-			5,	# +5 B:  A -> A#  
-			2,	# +6 F#: E -> E# (F)  
-			6,	# +7 C#: B -> B# (C)  
-  
-			3,	# -7 Cb: F -> Fb (E)  
-			0,	# -6 Gb: C -> Cb (B)  
-			4,	# -5 Db: G -> Gb  
-			1,	# -4 Ab: D -> Db  
-			5,	# -3 Eb: A -> Ab  
-			2,	# -2 Bb: E -> Eb  
-			6,	# -1 F:  B -> Bb  
-			]
-
-		""" 
-		Set the key via the table 
-		"""
-		self.key_table = [ 0 for n in range(7) ]
-
-		if key < -9 or key > 9:		# odd, but they should work...
+		if key < MIN_KEY or key > MAX_KEY:		# odd, but they should work...
 			print "Error: Key out of range (-7-7):", key
+			self.key_table = KEY_TABLES[0]
 			return
-		
-		if key == 0:
-			return
+		self.key_table = KEY_TABLES[key]
 
-		sign = key / abs(key)	# +1 or -1
-
-		for i in range(key, 0, -sign):
-			self.key_table[key_master[i]] = sign
-
-	
 	def show_key_table(self):
 		for i in range(6):
 			print "Note/adj:", i, self.key_table[i]
 	def show_acc(self):
-		for i in range(128):
-			print "key", i, self.accidentals[i] 
+		for i in range(TABLE_SIZE):
+			print "key", i, self.get_accidental(i)
+	def get_accidental(self, index):
+		"""
+		The accidental in effect for an index, 'None' if there isn't one
+		"""
+		if self.acc_generation[index] == self.generation:
+			return self.accidentals[index]
+		return 'None'
 	def set_accidental(self, octave, note, key_value):
 		""" convert note and octave to an index into the
 		    accidentals table
 		"""
 		index = octave * 12 + note
 		self.accidentals[index] = key_value
+		self.acc_generation[index] = self.generation
 		#print "Accidental set:", index, key_value
 	def adjust(self, note):
 		"""
 			take a note/noteoff object which has an octave and note
 			(0-7) and convert it to a MIDI note number...
+			An accidental overrides any key adjustment, otherwise it's
+			straight from the key's pitch table.
 		"""
+		index = note.note + note.octave * 12	# index into accidental / pitch tables
 
-		if note.key != self.key_signature:
-			self.key_signature = note.key
-			self.set_key(note.key)
-			#print "setting key to", note.key
-
-		adj = self.key_table[note.note]
-
-		key_num = note.note + note.octave * 12	# index into accidental table
-
-		note_num = self.NOTE_OFFSET[note.note] + note.octave * 12
-
-		accidental = self.accidentals[key_num]
-
-		if accidental != 'None':
-			adj = accidental	# override any key adjustment..
+		if self.acc_generation[index] == self.generation:
+			note.note_num = NATURAL_PITCHES[index] + self.accidentals[index]
+			return
 
-		note.note_num = note_num + adj
+		pitches = PITCH_TABLES.get(note.key)
+		if pitches is None:
+			self.set_key(note.key)		# complains...
+			pitches = NATURAL_PITCHES
+		note.note_num = pitches[index]
 		#print "Adjust: note / Octave / num / adj", note.note, note.octave, note.note_num, adj
 
 
 def main():
 	key = Key()
 	key.show_acc()
-	key.accidentals[120] = 3
+	key.set_accidental(10, 0, 3)
 	key.show_acc()
 	key.reset_accidentals()
 	key.show_acc()
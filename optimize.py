@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+	An optional pass over a parsed song, before it's written out, that
+	takes out MIDI events that don't do anything:
+
+		- more than one tempo, volume, key or time signature event
+		  at the same pulse in a track: only the last one counts
+		- an event that sets the tempo, volume, key or time signature
+		  to what it already is (ramps and restated keys leave plenty)
+
+	Smaller files, and less for the playback end to chew through.
+"""
+
+import MFF
+import songevents
+
+# The events we know how to judge, and the value each one sets
+SETTINGS = {
+	'VOLUME': lambda event: event.volume,
+	'TEMPO': lambda event: event.t_val,
+	'KEY': lambda event: (event.key, event.mode),
+	'TIME SIGNATURE': lambda event: (event.numerator, event.denominator),
+	}
+
+def redundant_rows(store):
+	"""
+	The rows of one track's store that can go, and a count of them 
+	by event type
+	"""
+	objects = store.objects
+	rows = [ row for row in store.order() if store.code[row] == songevents.OBJECT 
+		and objects[row].type in SETTINGS ]
+
+	drop = set()
+	counts = {}
+
+	# First: of several of a kind at the same pulse, only the last counts
+	latest = {}	# type -> row of the last one seen
+	for row in rows:
+		kind = objects[row].type
+		if kind in latest and store.pos[latest[kind]] == store.pos[row]:
+			drop.add(latest[kind])
+			counts[kind] = counts.get(kind, 0) + 1
+		latest[kind] = row
+
+	# Then: anything that doesn't change what's in effect
+	current = {}	# type -> value in effect
+	for row in rows:
+		if row in drop:
+			continue
+		event = objects[row]
+		value = SETTINGS[event.type](event)
+		if event.type in current and current[event.type] == value:
+			drop.add(row)
+			counts[event.type] = counts.get(event.type, 0) + 1
+		current[event.type] = value
+	return (drop, counts)
+
+def track_size(song, track_num):
+	"""
+	Bytes of MIDI data the track would come to (not counting the end 
+	of track or the chunk header - they don't change)
+	"""
+	return len(song.emit_track(track_num).data)
+
+def optimize_song(song):
+	"""
+	Take the redundant events out of every track.  Returns a 
+	tuple: events removed (total, and a dictionary by type) and 
+	bytes saved.
+	"""
+	removed = 0
+	counts = {}
+	saved = 0
+	for track_num in range(song.track_count):
+		store = song.track_events[track_num]
+		(drop, track_counts) = redundant_rows(store)
+		if not drop:
+			continue
+		before = track_size(song, track_num)
+		store.remove(drop)
+		saved += before - track_size(song, track_num)
+		removed += len(drop)
+		for (kind, count) in track_counts.items():
+			counts[kind] = counts.get(kind, 0) + count
+	return (removed, counts, saved)
+
+def report(results):
+	(removed, counts, saved) = results
+	detail = ", ".join([ "%d %s" % (counts[kind], kind.lower()) for kind in sorted(counts) ])
+	print "Optimizer: removed %d events (%s), %d bytes" % (removed, detail or "none", saved)
+
+"""
+Debug:
+"""
+def main():
+	song = songevents.Song()
+	song.add_track(MFF.Track_Chunk())
+	for (pos, volume) in (0, 100), (0, 96), (10, 96), (20, 96), (20, 97), (30, 98):
+		event = songevents.Volume()
+		event.pos = pos
+		event.volume = volume
+		event.track_num = 0
+		song.append(event)
+	results = optimize_song(song)
+	report(results)
+	left = [ (event.pos, event.volume) for event in song.all_events() ]
+	if left != [ (0, 96), (20, 97), (30, 98) ]:
+		print "Optimizer got it wrong:", left
+
+
+if __name__ == "__main__":
+	main()
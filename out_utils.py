@@ -4,9 +4,145 @@ Various output utilities...
 
 class Debug():
 	def __init__(self):
-		self.debug_level = 0	
+		self.debug_level = 0
 
 	def out(self, level, *args):
-		if level >= self.debug_level:
-			print args
+		"""
+		Print args if the debug level is up to level
+		"""
+		if self.debug_level >= level:
+			print print_line(args)
 
+def print_line(items):
+	"""
+	The line a print statement would make of items: each one str()'d,
+	a space between them - except after one ending in a tab or newline
+	"""
+	out = []
+	space = False
+	for item in items:
+		text = str(item)
+		if space:
+			out.append(' ')
+		out.append(text)
+		space = not (text and text[-1].isspace() and text[-1] != ' ')
+	return ''.join(out)
+
+#
+# Diagnostics: what the parser has to say about a score
+#
+# the kinds of warning
+SHORT_MEASURE = 'short measure'		# a barline before the measure was full
+LONG_MEASURE = 'long measure'		# ... or after it was over
+LONG_RESTART = 'long restart'		# a division ran past the end of the measure
+UNRESOLVED_TIE = 'unresolved tie'
+UNRECOGNIZED = 'unrecognized'		# a character that isn't a command
+BAD_KEY = 'bad key'
+BAD_NUMBER = 'bad number'		# a command's number missing
+UNTERMINATED = 'unterminated'		# no Z at the end
+
+KEEP = 10000	# most diagnostics kept as data (the rest are only counted)
+MAX_PER_KIND = 20	# most of any one kind printed, unless told otherwise
+
+class Diagnostic(object):
+	"""
+	One warning: its kind, where it was (offset into the text, the
+	measure number) and the lines it prints as - each a tuple of the
+	items a print statement would have had.
+	"""
+	__slots__ = ('kind', 'offset', 'measure', 'lines')
+
+	def __init__(self, kind, offset, measure, lines):
+		self.kind = kind
+		self.offset = offset
+		self.measure = measure
+		self.lines = lines
+
+	def __getstate__(self):		# (to pickle - e.g. back from a worker process)
+		return (self.kind, self.offset, self.measure, self.lines)
+
+	def __setstate__(self, state):
+		(self.kind, self.offset, self.measure, self.lines) = state
+
+	def text(self):
+		return '\n'.join([ print_line(line) for line in self.lines ])
+
+	def __repr__(self):
+		return "<%s at %d, measure %d>" % (self.kind, self.offset, self.measure)
+
+class Diagnostics():
+	"""
+	Collects the warnings from a parse.  Each one is kept (up to keep
+	of them) and counted by kind.  With echo, each is printed as it
+	comes, just as the parser always has - but no more than max_per_kind
+	of any one kind (None: no limit), so a damaged score can't flood
+	the output; the rest are only counted, and summary() says how many
+	weren't shown.  Nothing is formatted unless it's printed.
+	"""
+	def __init__(self, echo=True, max_per_kind=MAX_PER_KIND, keep=KEEP):
+		self.echo = echo
+		self.max_per_kind = max_per_kind
+		self.keep = keep
+		self.warnings = []	# the Diagnostics kept
+		self.counts = {}	# kind -> how many
+		self.total = 0
+
+	def warn(self, kind, offset, measure, *lines):
+		count = self.counts.get(kind, 0) + 1
+		self.counts[kind] = count
+		self.total += 1
+		diagnostic = None
+		if len(self.warnings) < self.keep:
+			diagnostic = Diagnostic(kind, offset, measure, lines)
+			self.warnings.append(diagnostic)
+		if self.echo and (self.max_per_kind is None or count <= self.max_per_kind):
+			if diagnostic is None:
+				diagnostic = Diagnostic(kind, offset, measure, lines)
+			print diagnostic.text()
+
+	def add(self, diagnostic):
+		"""
+		A warning from somewhere else (e.g. another Diagnostics)
+		"""
+		self.warn(diagnostic.kind, diagnostic.offset, diagnostic.measure, *diagnostic.lines)
+
+	def shown(self, kind):
+		"""
+		How many of a kind were printed
+		"""
+		if not self.echo:
+			return 0
+		if self.max_per_kind is None:
+			return self.counts.get(kind, 0)
+		return min(self.counts.get(kind, 0), self.max_per_kind)
+
+	def summary(self):
+		"""
+		Say what wasn't shown, if anything
+		"""
+		hidden = [ (kind, count - self.shown(kind)) for (kind, count) in sorted(self.counts.items())
+			if count > self.shown(kind) ]
+		if hidden:
+			print "Warnings not shown: %d (%s)" % (sum([ n for (kind, n) in hidden ]),
+				", ".join([ "%s: %d" % (kind, n) for (kind, n) in hidden ]))
+
+"""
+Debug:
+"""
+def main():
+	if print_line(("a:", 1, "b ", 2, "c\t", "d")) != "a: 1 b  2 c\td":
+		print "print_line doesn't match print:", repr(print_line(("a:", 1, "b ", 2, "c\t", "d")))
+	if Diagnostics().max_per_kind != MAX_PER_KIND:
+		print "Warnings aren't limited by default"
+	diagnostics = Diagnostics(echo=False, max_per_kind=2, keep=3)
+	for n in range(5):
+		diagnostics.warn(UNRECOGNIZED, n, 0, ("Unrecognized:", n))
+	diagnostics.warn(UNRESOLVED_TIE, 9, 1, ("Warning: unresolved tie.",))
+	if (diagnostics.total, len(diagnostics.warnings), diagnostics.counts[UNRECOGNIZED]) != (6, 3, 5):
+		print "Diagnostics counted wrong:", diagnostics.total, diagnostics.warnings, diagnostics.counts
+	else:
+		print "Diagnostics OK"
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+	Parsing one big score on several cores.
+
+	The score is split at barlines into chunks.  A measure
+	can't be parsed without knowing what came before it - the position,
+	tempo, key, octave, duration, time signature, which division we're
+	in... - so first a quick pre-scan goes through the whole score
+	with a Prescan parser (a parse.Checker): it keeps track of all of
+	that but makes no notes, no key work, nothing stored.  At each chunk
+	boundary it leaves a Checkpoint of its state.
+
+	Each chunk is parsed for real, in a pool of worker processes,
+	starting from its checkpoint - sent off as soon as the pre-scan
+	gets past it, so the workers are busy while it carries on (it's
+	about a third the work of a full parse).  The events come back a
+	chunk at a time and are added on, in order, to each track's store,
+	just as one parse would have added them.
+
+	Ties are the one thing that crosses chunks.  A tie moves the end of
+	the last note of its pitch, which may be in an earlier chunk.  The
+	pre-scan knows which note-off slots are filled at each boundary.
+	The worker gets a placeholder (External) for each filled slot, which
+	just adds up whatever ties do to it.  Those totals are put on the
+	real note-offs when the chunks are stitched together.
+
+	The worker's warnings (and any other output) are collected and
+	passed on in chunk order, so they read the same as a single parse.
+"""
+
+import os
+import sys
+import StringIO
+import multiprocessing
+
+import parse
+import songevents
+import out_utils
+
+CONTEXT = 31		# text either side of a chunk, for the "Unrecognized" message
+MIN_CHUNK = 64 * 1024	# not worth splitting smaller than this (characters)
+CHUNKS_PER_JOB = 4	# more chunks than workers: they start sooner, and finish together
+
+class Prescan(parse.Checker):
+	"""
+	Goes through the score keeping the parser's state, but making no
+	notes.  Leaves a Checkpoint in checkpoints at the first barline
+	past every chunk characters, and in filled, the note-off slots (for
+	ties) filled at that point.  on_checkpoint, if set, is called with
+	each one as it's made.
+	"""
+	def __init__(self, song, chunk):
+		parse.Checker.__init__(self, song, [], diagnostics=out_utils.Diagnostics(echo=False, keep=0))
+		self.chunk = chunk
+		self.split_at = chunk
+		self.filled = []	# the filled slots for each checkpoint: a list per track
+
+	def checkpoint(self):
+		if self.i < self.split_at:
+			return
+		cp = parse.Checkpoint(self)
+		self.checkpoints.append(cp)
+		self.filled.append([ [ slot for (slot, noteoff) in enumerate(slots) if noteoff != 'None' ]
+			for slots in self.noteoff_list ])
+		self.split_at = self.i + self.chunk
+		if self.on_checkpoint is not None:
+			self.on_checkpoint(cp)
+
+class External():
+	"""
+	Stands in (for a worker) for a note-off in an earlier chunk: adds
+	up the ties made to it
+	"""
+	def __init__(self, track_num, slot):
+		self.track_num = track_num
+		self.slot = slot
+		self.pos = 0
+
+def settings(song):
+	return (song.format, song.PPQ, song.time_factor, song.ramp_spacing, song.ramp_curve)
+
+def set_up(song, settings):
+	(song.format, song.PPQ, song.time_factor, song.ramp_spacing, song.ramp_curve) = settings
+	return song
+
+def pack_objects(store):
+	"""
+	A store's objects, to send back from a worker: (row, class, type,
+	dictionary) for each.  The position and track go without saying.
+	Pickling the events themselves took a few times longer.
+	"""
+	return [ (row, event.__class__, event.type, event.__dict__)
+		for (row, event) in enumerate(store.objects) if event is not None ]
+
+def unpack_objects(store, objects, offset):
+	"""
+	Put packed objects back in a store, their rows offset
+	"""
+	for (row, cls, type, attributes) in objects:
+		event = cls.__new__(cls)
+		event.__dict__ = attributes
+		event.type = type
+		event.pos = store.pos[offset + row]
+		event.track_num = store.track_num
+		store.objects[offset + row] = event
+
+def parse_chunk(job):
+	"""
+	In a worker: parse one chunk.  The text is just the chunk (and
+	a little either side), from base in the score; start and stop are
+	where in it the chunk starts and ends.  Returns what the chunk added
+	to each track - (rows as strings of the arrays' bytes, packed
+	objects) - the note-off left in each slot - { (track, slot): row } -
+	the ties made to earlier chunks - [ (track, slot, pulses) ] - the
+	warnings (offsets into the whole score) and any other output.
+	"""
+	(text, base, start, stop, checkpoint, track_list, filled, song_settings) = job
+	song = set_up(songevents.Song(), song_settings)
+	externals = []
+	diagnostics = out_utils.Diagnostics(echo=False, keep=sys.maxint)
+	stdout = sys.stdout
+	sys.stdout = output = StringIO.StringIO()
+	try:
+		parser = parse.Parser(song, diagnostics=diagnostics)
+		if checkpoint is not None:
+			for c in track_list:	# the tracks so far, made as they were
+				parser.do_division(c)
+			parser.restore(checkpoint)
+			for (t, slots) in enumerate(filled):
+				for slot in slots:
+					externals.append(External(t, slot))
+					parser.noteoff_list[t][slot] = externals[-1]
+		parser.start = start
+		parser.stop_at = stop
+		parser.parse(text)
+	finally:
+		sys.stdout = stdout
+
+	tracks = [ (store.pos.tostring(), store.code.tostring(), store.note_num.tostring(),
+		store.velocity.tostring(), pack_objects(store)) for store in song.track_events ]
+	noteoffs = {}
+	for (t, slots) in enumerate(parser.noteoff_list):
+		for (slot, noteoff) in enumerate(slots):
+			if isinstance(noteoff, songevents.NoteView):
+				noteoffs[(t, slot)] = noteoff.row
+	ties = [ (e.track_num, e.slot, e.pos) for e in externals if e.pos ]
+	for warning in diagnostics.warnings:
+		warning.offset += base
+	return (tracks, noteoffs, ties, diagnostics.warnings, output.getvalue())
+
+class Splitter():
+	"""
+	Makes a job for each chunk as the pre-scan finds where it ends,
+	and hands it straight to the pool (if there is one) - the workers
+	get going while the pre-scan's still running.
+	"""
+	def __init__(self, text, song, scan, pool):
+		self.text = text
+		self.settings = settings(song)
+		self.scan = scan
+		self.pool = pool
+		self.begin = 0		# where the next chunk starts...
+		self.state = None	# ... and the checkpoint there
+		self.results = []
+
+	def split(self, cp):
+		"""
+		A chunk ends at cp (None: at the end of the text)
+		"""
+		text = self.text
+		lo = max(0, self.begin - CONTEXT)
+		if cp is None:
+			(hi, stop) = (len(text), None)
+		else:
+			(hi, stop) = (min(len(text), cp.i + CONTEXT), cp.i - lo)
+		state = self.state
+		if state is None:
+			(track_list, filled) = ('', [])
+		else:
+			track_list = state.state[parse.PARSE_STATE.index('track_list')]
+			filled = self.scan.filled[len(self.results) - 1]
+		job = (text[lo:hi], lo, self.begin - lo, stop, state, track_list, filled, self.settings)
+		if self.pool is None:
+			self.results.append(job)	# parsed later, as they're stitched
+		else:
+			self.results.append(self.pool.apply_async(parse_chunk, (job,)))
+		if cp is not None:
+			self.begin = cp.i
+			self.state = cp
+
+	def chunks(self):
+		"""
+		Each chunk's result, in order
+		"""
+		for result in self.results:
+			if self.pool is None:
+				yield parse_chunk(result)
+			else:
+				yield result.get()
+
+def parse_parallel(text, song, jobs, chunks=None, diagnostics=None, quiet=False):
+	"""
+	Parse the text into the song (new and empty), using jobs worker
+	processes - or with jobs 1, the same steps in this process.  Prints
+	(and passes to diagnostics) what parse_text would - quiet is the
+	same too.  Returns the number of chunks.
+	"""
+	ours = diagnostics is None
+	if ours:
+		diagnostics = out_utils.Diagnostics()
+	if chunks is None:
+		chunks = jobs * CHUNKS_PER_JOB
+	pool = None
+	if jobs > 1 and len(text) >= 2 * MIN_CHUNK:
+		pool = multiprocessing.Pool(jobs)
+
+	# the pre-scan, handing out chunks as it goes
+	scan = Prescan(set_up(parse.NullSong(), settings(song)), max(MIN_CHUNK, len(text) / chunks))
+	splitter = Splitter(text, song, scan, pool)
+	scan.on_checkpoint = splitter.split
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')	# the workers will say it all again
+	try:
+		scan.parse(text)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+	splitter.split(None)
+
+	# stitch: the tracks are the pre-scan's (it made them all, in order)
+	for track in scan.song.track_list:
+		song.add_track(track)
+	noteoffs = {}	# (track, slot) -> row in the song
+	try:
+		for (tracks, chunk_noteoffs, ties, warnings, output) in splitter.chunks():
+			sys.stdout.write(output)
+			for warning in warnings:
+				diagnostics.add(warning)
+			offsets = [ len(store) for store in song.track_events ]
+			for (t, (pos, code, note_num, velocity, objects)) in enumerate(tracks):
+				store = song.track_events[t]
+				store.pos.fromstring(pos)
+				store.code.fromstring(code)
+				store.note_num.fromstring(note_num)
+				store.velocity.fromstring(velocity)
+				store.objects.extend([ None ] * (len(store.code) - len(store.objects)))
+				unpack_objects(store, objects, offsets[t])
+			for (t, slot, pulses) in ties:
+				song.track_events[t].pos[noteoffs[(t, slot)]] += pulses
+			for ((t, slot), row) in chunk_noteoffs.items():
+				noteoffs[(t, slot)] = offsets[t] + row
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+	if not scan.ended:
+		diagnostics.warn(out_utils.UNTERMINATED, len(text), scan.measure_num,
+			("Warning: file likely not properly terminated.",))
+	if ours:
+		diagnostics.summary()
+	if not quiet:
+		print "Final position:", scan.position
+		print "Measures:", scan.measure_num
+	return len(splitter.results)
+
+"""
+Debug:
+"""
+def main():
+	import io
+	import bench
+	for (size, divisions) in (400000, 'U:J*'), (200000, 'U:J*@'), (5000, 'U'):
+		text = parse.read_score(bench.synth_score(size, divisions=divisions))
+		outputs = []
+		for jobs in 1, 3:
+			song = bench.new_song()
+			with bench.Quiet():
+				if jobs == 1:
+					parse.parse_text(text, song)
+				else:
+					parse_parallel(text, song, jobs, chunks=7)
+				outfile = io.BytesIO()
+				song.create_MFF(outfile, None)
+			outputs.append(outfile.getvalue())
+		if outputs[0] != outputs[1]:
+			print "Parallel parse came out different:", size, divisions
+			return
+	print "Parallel parse OK"
+
+
+if __name__ == "__main__":
+	main()
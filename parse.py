@@ -9,28 +9,54 @@
 """
 
 
+import sys
+import mmap
+import string
+
 import songevents
 import MFF
+import key
+import out_utils
 
-def getnum(string):
+def getnum(text, i=0):
 	""" 
-	pull the next number off the current substring, 
-	returns a tuple of the number and the offset into
-	the string of the first non-digit.
-	"""
-
-	i=0
-	nstr=''
-	c=string[i]
-	while c in '0123456789':
-		nstr=nstr + c
-		i+=1
-		c=string[i]	# next char in string..
+	pull the next number off the text, starting at index i,
+	returns a tuple of the number and the offset from i
+	of the first non-digit.
+
+	The scan is done in place by index - we never copy the rest 
+	of the file just to read a couple of digits off the front of it
+	(that made long scores quadratic).
+	"""
+
+	j=i
+	length=len(text)
+	while j < length and text[j] in '0123456789':
+		j+=1
 	try:
-		n=int(nstr)
+		n=int(text[i:j])	# just the digits...
 	except ValueError, info:
 		raise ValueError(info)	# handled at higher level
-	return (n,i)
+	return (n,j-i)
+
+def getcomment(text, i):
+	"""
+	Find the end of a comment that starts at index i (just past the
+	opening quote).  Returns a tuple of the comment text and the index 
+	of the closing quote.  Like getnum, searches in place.
+	"""
+	end=text.find('"', i)	# position of the next " in the full text
+	if end < 0:
+		end=i-1		# no closing quote - empty comment, carry on after the "
+	return (spaced(text[i:end]), end)
+
+# cr/lf used to be turned into spaces before parsing - now they're 
+# left in the text and skipped, but anything we pass on or print
+# from the text still shows them as spaces
+SPACES = string.maketrans('\r\n', '  ')
+
+def spaced(text):
+	return text.translate(SPACES)
 
 uS_PER_MINUTE = 60 * 1000000	# microseconds per minute
 
@@ -49,6 +75,7 @@ def mk_tempo_event(song, tempo, pos, q_dur, n_dur):
 	tempo_event.pos = pos
 	# uS_PER_MINUTE = 60000000
 	t_val = (uS_PER_MINUTE / tempo) * q_dur / n_dur
+	tempo_event.base = t_val	# kept for Song.rescale
 	tempo_event.t_val = int(t_val * song.time_factor)  # tempo correction for sync
 	#print "Tempo event b/a/f:", t_val, tempo_event.t_val, song.time_factor
 	# 
@@ -67,594 +94,1154 @@ def mk_volume_event(song, volume, pos, track_num):
 				
 	song.append(vol_event)
 		
-def parse_song(filename, song):
-	"""
-	We read the file into a string and them step through it
-	dealing with the characters in a loop, processing them
-	through a long if statement..
+# some constants
+# Note / pitch specific
+NOTES='CDEFGAB'		# 'C' is the first note of each octave
+OCTAVES='0123456789'	# octave specifier C4 = middle C	
+OCT_OFFSET = 1		# MIDI Octave adjust
+ACCIDENTALS = '!%#'	# flat, natural, sharp
 
-	At the end we have a song object that contains a long 
-	list of events: notes, tempo changes, comments, etc.
+# Note duration...
+DURATIONS='WHQISTX'     # Whole, Half, Quarter, eIgth, Sixteenth, Thirty-second, siXty-fourth
+DUR_NAMES=[ 'Whole', 'Half', 'Quarter', 'Eighth', 'Sixteenth', 'Thirty-second', 'Sixty-fourth' ]
+
+# Divisions - these map to tracks in the MIDI file
+DIVISIONS='U*:JLMY@P\\'	# Characters to specify division (note: \\ a single backslash at end)
+DIV_NAMES=[ 'Great Division', 'Positiv Division', 'Pedal Division', 'Swell I Division',
+	'Swell II Division', 'Unknown Division', 'Antiphonal Division', 'Trompeta Real', 
+	'Chimes', 'PDP-8 Electronic Division' ]
+
+IGNORE=' \r\n'
+STOP='Z'
+
+# What a Checkpoint keeps of the parser: everything that carries on
+# from one measure to the next (accidentals and ties don't)
+PARSE_STATE = ( 'position', 'last_measure', 'measure_length', 'measure_num',
+	'tempo', 'volume', 'key', 'octave', 'duration', 'half_dur', 'staccato_dur', 
+	'tuplet', 'staccato', 'fermata', 'fermata_add', 'accidental', 'solo', 
+	'grouping', 'group_length', 'ramp_duration', 'track_list', 'track_num', 
+	'ended', 'last_o' )
+
+class Checkpoint(object):
 	"""
-	
-	staccato = False
-	fermata = False
-	fermata_add = 0
-	accidental = 'None'
-	tuplet = False
-	#tied... ties are kept on a per-track basis
-	solo = False
-	ended = False
-	grouping = False
-	tempo = 120
-	uS_per_quarter = uS_PER_MINUTE / tempo 	# (500000 -> microseconds per quarter note)
-	volume = 96		# default starting value...
-	
-	key = 0
-	song.measure_num = 0
-	last_measure = 0
-	group_length = 0
-	position = 0	# where are we in the "song" in pulses
-	ramp_duration = 0
-	current_track = 'None'
-	track_list = ''
-
-	# some constants
-	# Note / pitch specific
-	NOTES='CDEFGAB'		# 'C' is the first note of each octave
-	OCTAVES='0123456789'	# octave specifier C4 = middle C	
-	OCT_OFFSET = 1		# MIDI Octave adjust
-	ACCIDENTALS = '!%#'	# flat, natural, sharp
-	
-	# Note duration...
-	DURATIONS='WHQISTX'     # Whole, Half, Quarter, eIgth, Sixteenth, Thirty-second, siXty-fourth
-	DUR_NAMES=[ 'Whole', 'Half', 'Quarter', 'Eighth', 'Sixteenth', 'Thirty-second', 'Sixty-fourth' ]
+	The parser's state just after a barline, so a parse can be picked 
+	up again from there (see incremental.py).  i is where in the text,
+	rows the number of rows in each track's store.  Along with it, what
+	the measure that ended here did that reaches outside the state:
+	the note-offs it left for ties - notes: (track, slot) -> row - and 
+	the ties it made - ties: [ (track, row, pulses) ].  Those rows are 
+	kept relative to rows (negative), so they still hold when the rows
+	before them change.
+	"""
+	__slots__ = ('i', 'state', 'rows', 'notes', 'ties')
 
-	# Divisions - these map to tracks in the MIDI file
-	DIVISIONS='U*:JLMY@P\\'	# Characters to specify division (note: \\ a single backslash at end)
-	DIV_NAMES=[ 'Great Division', 'Positiv Division', 'Pedal Division', 'Swell I Division',
-		'Swell II Division', 'Unknown Division', 'Antiphonal Division', 'Trompeta Real', 
-		'Chimes', 'PDP-8 Electronic Division' ]
+	def __getstate__(self):		# (to pickle - e.g. to send to a worker process)
+		return (self.i, self.state, self.rows, self.notes, self.ties)
 
-	IGNORE=' \n'
-	STOP='Z'
+	def __setstate__(self, state):
+		(self.i, self.state, self.rows, self.notes, self.ties) = state
 
-	#
-	# First tricky bit...  create a dictionary of pulse values for each of the 
-	# durations.  Start with a whole note (4 quarters) and divide by two for
-	# each of the subsequent notes.  (Saves us doing an exponential each time)
-	note_durations={}	
-	pulses=song.PPQ * 4 	# length of a whole note...
-	for c in DURATIONS:
-		note_durations[c]=pulses
-		pulses=pulses/2
-	duration = song.PPQ 		# just to get rid of the warning - assigned on the fly...
-	staccato_dur = duration / 2
-
-	#for c in DURATIONS:
-	#	print "Duration of note", c, "is", note_durations[c]
-
-	measure_length = song.PPQ * 4	# initial for any "pre" measures...
-	
-	infile = open(filename)
-	text = infile.read()	# the entire file
-	for x in '\r', '\n':	# convert cr/lf to space
-		text = text.replace(x,' ')	# convert to space
+	def __init__(self, parser):
+		self.i = parser.i
+		self.state = tuple([ getattr(parser, name, None) for name in PARSE_STATE ])
+		self.rows = tuple([ len(store) for store in parser.song.track_events ])
+		rows = self.rows
+		self.notes = dict([ (slot, row - rows[slot[0]]) for (slot, row) in parser.measure_notes.items() ])
+		self.ties = [ (t, row - rows[t], pulses) for (t, row, pulses) in parser.measure_ties ]
 
-	# create the initial track (or for format 0, the only track)
-	track_num = 0
-	
-	track = MFF.Track_Chunk()
-	track.name = "Track 0 - Tempo, etc."
-	song.track_list.append(track)
-	song.track_count += 1
-	
-	i=0	# index into the text string, which is the enire file
-	length=len(text)
+class Parser():
+	"""
+	The state of a parse, and a handler for each command character.
 
-	while i < length:
-		# Now we step through the file, looking at each letter,
-		# creating an event (note, tempo, etc.) as we go...
-		# the expectation is that the 'Z' end character will show up before 
-		# this loop ends.   
-		#
-		# we just check each letter, keep track of the data, and creating "events", 
-		# which can be notes, comments, tempo changes, as needed.  Comments can be 
-		# generated as they are encountered.   Tempo changes as well, and gradual 
-		# accellerations / decellerations,volume changes can be emitted at once.
-		# Notes are bit different, we have to peak ahead for a possible octave value.
-		# When we create the note, we also created a note-off event.  When tied to 
-		# another note, the note-off is moved forward in time.
-		#
-		c=text[i]	# next character...
-		i+=1
-		#
-		# --------------------Note: pitch and timing
-		#
-		# Note  - start a new note...
-		if c in NOTES:
-
-			#  Create a new note... - set the note, position, key and duration 
-			this_note = NOTES.find(c)
-
-			# The note could be followed by an octave specifier....
-			# peek ahead 
-			o = text[i] # check for possible octave
-			if o in OCTAVES:
-				#print "Following octave found:", o
-				octave = int(o) + OCT_OFFSET
-				i += 1	# next char...
-			else:	# octave set?
-				try:
-					o = octave	
-				except NameError:
-					#print "Error: octave not set before note"
-					octave = 5
-			# Is this a tied note?  If so, we do not generate a new note, we find the note-off
-			# we already generated, and add the current note duration to its position
-			if current_track.tied:
-				tied_event = song.track_list[track_num].noteoff_list[octave*12+this_note]
-				if  tied_event != 'None':
-					tied_event.pos += duration
-					current_track.tied = False
-					#print "Tying note", track_num, tied_event.pos
-				
-			else:
-					
-				note_ev = songevents.Note()	# new note event...
-				note_ev.note = this_note	# 0-6 - note value w/i octave
-				note_ev.key = key
-				note_ev.dur = duration
-				note_ev.pos = position
-				note_ev.track_num = track_num
-	
-				#print "New note Accidental:", accidental
-	
-				#
-				note_ev.octave = octave
-	
-				#print 'emitting note: ', c, "#/octave", note_ev.note, note_ev.octave, "pos:", note_ev.pos, "duration:", duration, note_ev.dur, "track:", track_num
-				if accidental != 'None':
-					#print "Setting accidental:",  note_ev.octave, note_ev.note, accidental
-					song.key.set_accidental(note_ev.octave, note_ev.note, accidental)
-					accidental = 'None'
-	
-				song.append(note_ev)
-	
-				noteoff=songevents.NoteOff()	# new note-off
-				if staccato:
-					note_len = staccato_dur
-				elif fermata:
-					fermata_add = duration	# add to note, and to measure 
-					note_len = duration + fermata_add
-					
-				else:
-					note_len = note_ev.dur - 1	# to prevent collisions / stuck notes
-				noteoff.pos = note_ev.pos + note_len
-				noteoff.octave = note_ev.octave
-				noteoff.note = note_ev.note
-				noteoff.key = note_ev.key
-				noteoff.track_num = track_num
-	
-				#print 'emitting note off: ', this_note, "#/octave", note_ev.note, note_ev.octave, "pos:", noteoff.pos
-				# now... add the note off to this track's note-off list for possible ties
-				song.track_list[track_num].noteoff_list[octave*12+this_note] = noteoff # this event
-	
-				song.append(noteoff)	# add the note off...
+	Rather than running every character down a long if statement
+	(spaces and barlines - the most common characters - were near
+	the bottom) we build a table of handlers, one entry per possible
+	character, so each character costs a single lookup.  Characters 
+	to be ignored map to None.
 
+	Handlers read the text and the index (self.text, self.i) and may
+	move the index forward past any arguments.  A handler returns
+	True to stop the parse.
 
-			# Update position...
-			if grouping:
-				#print "Grouping (note) - don't advance..."
-				# The length of a group is the length of the shortest note...
-				if group_length > duration:
-					group_length = duration
-					#print "group len", group_length
-			else:
-				position += duration
-				#print "New, post note, position:", position
-		
-		#
-		# Rest - a note with out all the work
-		#   - just move the pointer forward...
-		#
-		elif c == 'R':
-			#print "Rest"
-			if grouping:
-				# The length of a group is the length of the shortest note...
-				#print "Grouping (rest) - don't advance..."
-				if group_length > duration:
-					group_length = duration
-					#print "group len", group_length
-			else:
-				position += duration
-				#print "New, post rest, position", position
-		#
-		#
-		#  ------------------------Pitch:  octave, accidentals, key
-		#
-		# Octave 
-		#
-		elif c in OCTAVES:
-			octave=int(c) + OCT_OFFSET	# we know it's a digit...
-			#print 'octave: ', c, octave
+	Pass a list as checkpoints and a Checkpoint is added to it at each
+	barline; on_checkpoint, if set, is called with each one, and can
+	stop the parse by returning True.  A parser can also start from a 
+	checkpoint (resume) rather than from the top - the song should 
+	already hold what was parsed before it.  With stop_at set, the
+	parse stops at the first barline at or past there.
 
+	Warnings go to diagnostics (an out_utils.Diagnostics) - by 
+	default, a new one that prints them as they come.
+	"""
+	def __init__(self, song, checkpoints=None, resume=None, diagnostics=None):
+		self.song = song
+		if diagnostics is None:
+			diagnostics = out_utils.Diagnostics()
+		self.diagnostics = diagnostics
+		self.checkpoints = checkpoints
+		self.on_checkpoint = None
+		self.stop_at = None
+		self.measure_notes = {}		# for the checkpoint: note-offs set this measure
+		self.measure_ties = []		# ... and ties made
+
+		self.staccato = False
+		self.fermata = False
+		self.fermata_add = 0
+		self.accidental = 'None'
+		self.tuplet = False
+		#tied... ties are kept on a per-track basis
+		self.tied = []		# per track: is there a tie pending?
+		self.noteoff_list = []	# per track: the last note-off for each note, for ties
+		self.solo = False
+		self.ended = False
+		self.grouping = False
+		self.tempo = 120
+		self.volume = 96		# default starting value...
 		
+		self.key = 0
+		self.key_info = key.Key()	# accidentals in force this measure
+		self.start = 0		# where in the text to start
+		self.measure_num = 0
+		self.last_measure = 0
+		self.group_length = 0
+		self.position = 0	# where are we in the "song" in pulses
+		self.ramp_duration = 0
+		self.track_list = ''
+		self.track_num = 0
+		self.octave = None	# must be set before the first note (else 5)
+
 		#
-		# Accidentals...
-		#
-		elif c in ACCIDENTALS:
-			#print "Accidental found:", c, "this note", this_note
-			# ! => flat, # => sharp, % => natural
-			# set the value for the current note to -1, 0, or 1
-			accidental = ACCIDENTALS.find(c) - 1	# -1 => flat, 0 => natural +1 => flat
-			#print "setting Accidental:", accidental
-			# This will be processed at the next note...
-		#
-		#  Key...
-		#
-		elif c == 'K':		# new key...
-			try:
-				c=text[i]
-				k=int(c)
-			except ValueError, info:
-				print "ERROR: Expected a digit for key, got:", c, "- Info:", info
-			else:
-				if k == 0:	
-					key=0	# key of C (Am)
-				else:	#only parse the flat/sharp if the key is not C (0)
-					i+=1
-					c = text[i]
-					
-					if c == '#':	# sharp key
-						key=k
-					elif c == '!':	# flat key - negative...
-						key=-k
-					else:
-						print "ERROR: Expected # or ! for key, got:", c
-						key=0	# kludge to prevent a blowup on the print...
-				#print "Key set to", key
-				key_event = songevents.Key_Event()	# new key event...
-				key_event.key = key
-				key_event.pos = position
-
-				song.append(key_event)
-			i+=1
-		#
-		#
-		# -------   Timing: note duration, tuplets, staccato, fermata
-		#
-		# Note durations... whole, half, quarter, etc.
-		#
-		elif c in DURATIONS:
-			duration=note_durations[c]
-			if tuplet:
-				duration = duration * 2 / tuplet
-			half_dur=duration / 2	# for dotted notes...
-			staccato_dur=half_dur	# about right most of the time.
-
-			index=DURATIONS.find(c)	# index into the names list...
-			#print 'Duration: ', c, '/', DUR_NAMES[index], ', duration:',  note_durations[c]
-				
-			if staccato:
-				staccato = False
-				#print "Staccato is:", staccato
-			if fermata:
-				fermata = False
-				#print "Fermata is:", fermata
-		#
-		# Dot... (add half)
-		elif c == ".":
-			try:
-				d=duration	# is it set yet?
-			except:
-				print "ERROR: Dot found before duration set - check file format"
-			else:
-				duration+=half_dur
-				half_dur = half_dur / 2	# for a subsequent dot...
-				#print "dot: duration is", duration
-
-		elif c == "'":	# tuplets...
-			if tuplet:
-				tuplet = False
-				#print "Tuplet ended."
-			else:
-				try:
-					(tuplet, offset) = getnum(text[i:]) 
-				except ValueError, info:
-					print "Tuplet value not found...", info
-				#else:
-					#duration = duration * 2 / tuplet # only if no dur specified at start of tuplet
-					#print "Tuplet started:", tuplet
-				i += offset
-		#
-		# Duration modifiers...
-		#
-		# Staccato..
-		elif c == '^':		
-			staccato=True	# shorter note
-			#print "Staccato is:", staccato
-		# Fermata...
-		elif c == '?':
-			fermata=True	# longer note (and measure)
-		#
-		# Tie...
-		# This one's a bit tricky as we've already created the event, but
-		# here we just set the flag.  The Note code will deal with it
-		elif c == '&':
-			#print "TIE!"
-			current_track.tied = True
-		#
-		#
-		# ------------------   Timing: tempo, time signature
-		#
-		# Tempo 
-		# 
-		elif c == '=':
-			try:
-				(new_tempo, offset)=getnum(text[i:])
-			except ValueError, info:
-				#print "Expected to find a number for tempo,", info
+		# First tricky bit...  create a dictionary of pulse values for each of the 
+		# durations.  Start with a whole note (4 quarters) and divide by two for
+		# each of the subsequent notes.  (Saves us doing an exponential each time)
+		self.note_durations={}	
+		pulses=song.PPQ * 4 	# length of a whole note...
+		for c in DURATIONS:
+			self.note_durations[c]=pulses
+			pulses=pulses/2
+		self.duration = song.PPQ 		# assigned on the fly...
+		self.half_dur = self.duration / 2
+		self.staccato_dur = self.duration / 2
+
+		self.measure_length = song.PPQ * 4	# initial for any "pre" measures...
+
+		self.dispatch = self.build_dispatch()
+
+		if resume is not None:
+			self.restore(resume)
+			return
+
+		# create the initial track (or for format 0, the only track)
+		track = MFF.Track_Chunk()
+		track.name = "Track 0 - Tempo, etc."
+		self.add_track(track)
+
+	def restore(self, checkpoint):
+		"""
+		Pick up the state from a checkpoint.  The note-offs left for
+		ties aren't in it - set noteoff_list after, if they're wanted.
+		"""
+		for (name, value) in zip(PARSE_STATE, checkpoint.state):
+			setattr(self, name, value)
+		self.start = checkpoint.i
+		self.tied = [ False for t in checkpoint.rows ]
+		self.noteoff_list = [ [ 'None' for i in range(128) ] for t in checkpoint.rows ]
+
+	def checkpoint(self):
+		"""
+		At a barline: note where we are.  Returns True to stop.
+		"""
+		cp = Checkpoint(self)
+		self.checkpoints.append(cp)
+		self.measure_notes = {}
+		self.measure_ties = []
+		if self.on_checkpoint is not None:
+			return self.on_checkpoint(cp)
+
+	def build_dispatch(self):
+		"""
+		One entry for each of the 256 characters.  Where a character
+		shows up in more than one set the first one wins, as it 
+		would have in the old if/elif chain.
+		"""
+		table = [
+			(NOTES, self.do_note),
+			('R', self.do_rest),
+			(OCTAVES, self.do_octave),
+			(ACCIDENTALS, self.do_accidental),
+			('K', self.do_key),
+			(DURATIONS, self.do_duration),
+			('.', self.do_dot),
+			("'", self.do_tuplet),
+			('^', self.do_staccato),
+			('?', self.do_fermata),
+			('&', self.do_tie),
+			('=', self.do_tempo),
+			('$', self.do_time_signature),
+			('/', self.do_measure),
+			(';', self.do_restart),
+			('@', self.do_solo),
+			('V', self.do_volume),
+			('+-<>', self.do_ramp),
+			('(', self.do_group_start),
+			(')', self.do_group_end),
+			('N', self.do_voicing),
+			(DIVISIONS, self.do_division),
+			('O', self.do_orchestration),
+			('"', self.do_comment),
+			(IGNORE, None),
+			(STOP, self.do_stop),
+			]
+		dispatch = {}
+		for (chars, handler) in table:
+			for c in chars:
+				dispatch.setdefault(c, handler)
+		for n in range(256):
+			dispatch.setdefault(chr(n), self.do_unrecognized)
+		return dispatch
+
+	def add_track(self, track):
+		"""
+		A new track in the song, and our tie state for it
+		"""
+		self.song.add_track(track)
+		self.tied.append(False)
+		# create a table of note off events for each "note" (<128 86 should be enough..)
+		self.noteoff_list.append([ 'None' for i in range(128) ])
+
+	def clear_ties(self):
+		for track_num in range(len(self.tied)):
+			if self.tied[track_num]:
+				self.warn(out_utils.UNRESOLVED_TIE, ("Warning: unresolved tie.",))
+				self.tied[track_num] = False
+
+	def warn(self, kind, *lines):
+		"""
+		A warning about here in the text (see out_utils.Diagnostics)
+		"""
+		self.diagnostics.warn(kind, self.i, self.measure_num, *lines)
+
+	def parse(self, text):
+		"""
+		Step through the text, looking at each letter, creating 
+		an event (note, tempo, etc.) as we go...
+		the expectation is that the 'Z' end character will show up before 
+		this loop ends.   
+		"""
+		self.text = text
+		self.i = self.start	# index into the text string, which is the enire file
+		length = len(text)
+		dispatch = self.dispatch
+
+		while self.i < length:
+			c = text[self.i]	# next character...
+			self.i += 1
+			handler = dispatch[c]
+			if handler is None:
 				continue
+			if handler(c):
+				break
+
+	#
+	# --------------------Note: pitch and timing
+	#
+	def do_note(self, c):
+		"""
+		Note  - start a new note...
+		When we create the note, we also created a note-off event.  When tied to 
+		another note, the note-off is moved forward in time.
+		"""
+		song = self.song
+		text = self.text
+		track_num = self.track_num
+		duration = self.duration
+
+		#  Create a new note... - set the note, position, key and duration 
+		this_note = NOTES.find(c)
 
-			i+=offset	# point to the next char...
+		# The note could be followed by an octave specifier....
+		# peek ahead 
+		try:
+			o = text[self.i] # check for possible octave
+		except IndexError:	# the text ends on the note
+			o = ' '
+		if o in OCTAVES:
+			#print "Following octave found:", o
+			self.octave = int(o) + OCT_OFFSET
+			self.i += 1	# next char...
+		elif self.octave is None:
+			#print "Error: octave not set before note"
+			self.octave = 5
+		octave = self.octave
+
+		# Is this a tied note?  If so, we do not generate a new note, we find the note-off
+		# we already generated, and add the current note duration to its position
+		if self.tied[track_num]:
+			tied_event = self.noteoff_list[track_num][octave*12+this_note]
+			if  tied_event != 'None':
+				tied_event.pos += duration
+				self.tied[track_num] = False
+				if self.checkpoints is not None:
+					self.measure_ties.append((track_num, tied_event.row, duration))
+				#print "Tying note", track_num, tied_event.pos
 			
-			# tempo is in "beats" per minute, where beats is the
-			# current duration.  The value we store is microseconds per
-			# quarter note.  So:
-			# We take microseconds per minute, divide by tempo, then correct
-			# with  a factor of a quarter note / current note...
-			#
-			# If ramp_duration is set - we issue a series of events going forward in 
-			# time (they'll be sorted into the correct order later).   If ramp_duration
-			# is zero, we make one.
-			q_dur = note_durations['Q']	# duration of a quarter note
-			n_dur = duration			# duration of current note 							]
-			if ramp_duration == 0:
-				mk_tempo_event(song, new_tempo, position, q_dur, n_dur)
-			else:
-				# calculate a reasonable increment for the position / tempo increment,
-				# then create a series of events...
-				t_diff = new_tempo - tempo
-				if t_diff == 0:
-					#print "Warning: tempo ramp specified with no change: dur/tempo", ramp_duration, tempo, new_tempo
-					ramp_duration = 0
-					continue	# no change
-				t_size = abs(t_diff)
-				t_sign = t_diff / t_size	# -1 or +1 
+		else:
 				
-				# let's assume there will be many more pulses than tempo points 
-				# so issue a tempo event for tempo point change
-				pos = position
-				dur_incr = ramp_duration / t_size
-				for t in range(tempo, new_tempo, t_sign):
-					mk_tempo_event(song, t, pos, q_dur, n_dur)
-					pos += dur_incr 
-				mk_tempo_event(song, new_tempo, position+ramp_duration, q_dur, n_dur)
-			tempo = new_tempo
-			ramp_duration = 0
-	
+			note_ev = songevents.Note()	# new note event...
+			note_ev.note = this_note	# 0-6 - note value w/i octave
+			note_ev.key = self.key
+			note_ev.dur = duration
+			note_ev.pos = self.position
+			note_ev.track_num = track_num
+			note_ev.octave = octave
 
-		#
-		# Time Signature (Meter) - generates an event...
-		#
-		elif c == '$':	# meter change...  (n)n-m   where nn is numerator, m denom
+			if self.accidental != 'None':
+				#print "Setting accidental:",  note_ev.octave, note_ev.note, accidental
+				self.key_info.set_accidental(note_ev.octave, note_ev.note, self.accidental)
+				self.accidental = 'None'
 
-			try:
-				(ts_num, offset) = getnum(text[i:])
-			except ValueError, info:
-				ts_num=4
-				print "Expected time signature number, got:", str, info
-				print "Assuming:", ts_num
+			# the MIDI note number is worked out once, here, and the 
+			# note-off gets the same one
+			self.key_info.adjust(note_ev)
+			song.append(note_ev)
 
-			i += offset + 1 	# past the "-"
-			try:
-				(ts_denom, offset) = getnum(text[i:])
-			except ValueError, info:
-				ts_denom=4
-				print "Expected a time signature denominotor, got:", c
-				print "Assuming: 4"
-
-			i += offset
-
-			# set measure to the length of a whole note times the time signature
-			measure_length = note_durations['W'] * ts_num / ts_denom
-			#print "Setting time signature to %d/%d." % (ts_num, ts_denom)
-			#print "Measure length is:", measure_length
-			# now we get slightly tricky, the MFF wants us to emit
-			# four values, numerator, dnomingtaro (as a negative power of two: 2 => Q)
-			# MIDI clocks in a click
-			ts_event = songevents.Time_Signature()
-			ts_event.ppq = song.PPQ
-			ts_event.numerator = ts_num
-			ts_event.denominator = ts_denom
-			ts_event.pos = position
-			song.append(ts_event)		# add to the song
+			noteoff=songevents.NoteOff()	# new note-off
+			if self.staccato:
+				note_len = self.staccato_dur
+			elif self.fermata:
+				self.fermata_add = duration	# add to note, and to measure 
+				note_len = duration + self.fermata_add
+			else:
+				note_len = note_ev.dur - 1	# to prevent collisions / stuck notes
+			noteoff.pos = note_ev.pos + note_len
+			noteoff.octave = note_ev.octave
+			noteoff.note = note_ev.note
+			noteoff.key = note_ev.key
+			noteoff.note_num = note_ev.note_num
+			noteoff.track_num = track_num
 
-		#
-		# New measure - move the position forward... 
-		#
-		elif c == '/':
-				
-			#print "new measure"
-			newpos = last_measure + measure_length
-			
-			if newpos > position:
-				print "Warning: position was short of new measure:", song.measure_num, position, newpos
+			# now... add the note off, and keep it in this track's note-off list for 
+			# possible ties (what we keep is the song's view of the stored event)
+			noteoff = song.append(noteoff)
+			self.noteoff_list[track_num][octave*12+this_note] = noteoff
+			if self.checkpoints is not None:
+				self.measure_notes[(track_num, octave*12+this_note)] = noteoff.row
+
+		self.advance()
+
+	def advance(self):
+		"""
+		Update position after a note or rest...
+		"""
+		if self.grouping:
+			# The length of a group is the length of the shortest note...
+			if self.group_length > self.duration:
+				self.group_length = self.duration
+		else:
+			self.position += self.duration
+
+	def do_rest(self, c):
+		"""
+		Rest - a note with out all the work
+		  - just move the pointer forward...
+		"""
+		self.advance()
+
+	#
+	#  ------------------------Pitch:  octave, accidentals, key
+	#
+	def do_octave(self, c):
+		self.octave=int(c) + OCT_OFFSET	# we know it's a digit...
+
+	def do_accidental(self, c):
+		"""
+		! => flat, # => sharp, % => natural
+		set the value for the current note to -1, 0, or 1
+		This will be processed at the next note...
+		"""
+		self.accidental = ACCIDENTALS.find(c) - 1	# -1 => flat, 0 => natural +1 => flat
+
+	def do_key(self, c):
+		"""
+		Key... a digit, then # or ! unless the key is 0
+		"""
+		text = self.text
+		try:
+			c=text[self.i:self.i + 1]	# ('' at the end of the text)
+			k=int(c)
+		except ValueError, info:
+			self.warn(out_utils.BAD_KEY, ("ERROR: Expected a digit for key, got:", spaced(c), "- Info:", info))
+		else:
+			if k == 0:	
+				self.key=0	# key of C (Am)
+			else:	#only parse the flat/sharp if the key is not C (0)
+				self.i+=1
+				c = text[self.i:self.i + 1]
 				
-			while newpos < position:
-				print "Warning: current position:", position, "is greater than next measure/position:", song.measure_num, newpos
-				newpos += measure_length + fermata_add	# keep adding to the measure pointer to catch up with position.
-				fermata_add = 0	# allows a one-time addition to a bar for the longest held note
-			
-			position = newpos
-			last_measure = position
-			
-			if solo:
-				solo = False
-				#print "Solo mode;", solo
-			song.measure_num += 1
-			#print "new measure:", song.measure_num
-			# new measure resets all accidentals...
-			song.key.reset_accidentals()
-			song.clear_ties()
-		#
-		# restart measure - reset position, clear accidentals
-		elif c == ';':
-			barend = last_measure + measure_length
-			if position > barend:
-				print "Warning: restarted measure would be long: ",song.measure_num, position, barend
-			position = last_measure
-			#print "restart measure", position
-			# new measure resets all accidentals...
-			song.key.reset_accidentals()
-			if solo:
-				solo = False
-				#print "Solo mode;", solo
-		elif c == "@":
-			solo = True
-			#print "Solo mode:", solo
-		elif c == '?':
-			fermata = True
-			#print "Fermata is:", fermata
-			
-		#
-		#
-		# --------------  Misc:  1	`, grouping, Divisions (tracks), orchestration 
-		#
-		elif c == 'V':	# volume
+				if c == '#':	# sharp key
+					self.key=k
+				elif c == '!':	# flat key - negative...
+					self.key=-k
+				else:
+					self.warn(out_utils.BAD_KEY, ("ERROR: Expected # or ! for key, got:", spaced(c)))
+					self.key=0	# kludge to prevent a blowup on the print...
+			self.key_event()
+		self.i+=1
+
+	def key_event(self):
+		key_event = songevents.Key_Event()	# new key event...
+		key_event.key = self.key
+		key_event.pos = self.position
+
+		self.song.append(key_event)
+
+	#
+	# -------   Timing: note duration, tuplets, staccato, fermata
+	#
+	def do_duration(self, c):
+		"""
+		Note durations... whole, half, quarter, etc.
+		"""
+		duration=self.note_durations[c]
+		if self.tuplet:
+			duration = duration * 2 / self.tuplet
+		self.duration = duration
+		self.half_dur=duration / 2	# for dotted notes...
+		self.staccato_dur=self.half_dur	# about right most of the time.
+
+		self.staccato = False
+		self.fermata = False
+
+	def do_dot(self, c):
+		"""
+		Dot... (add half)
+		"""
+		self.duration+=self.half_dur
+		self.half_dur = self.half_dur / 2	# for a subsequent dot...
+
+	def do_tuplet(self, c):
+		if self.tuplet:
+			self.tuplet = False
+			#print "Tuplet ended."
+		else:
 			try:
-				(vol, offset) = getnum(text[i:])
+				(self.tuplet, offset) = getnum(self.text, self.i) 
 			except ValueError, info:
-				print "No volume value found", info
-				continue
-			
-			new_volume = ( vol & 0x3f ) + 64 	# 0-63 maps to MIDI vol 64-127
-			#print "Volume event:", volume, "->", new_volume, "ramp_duration:", ramp_duration
-			if ramp_duration == 0:
-				mk_volume_event(song,new_volume, position, track_num)
+				self.warn(out_utils.BAD_NUMBER, ("Tuplet value not found...", info))
 			else:
-				# calculate a reasonable increment for the position / tempo increment,
-				# then emit a series of events...
-				v_diff = new_volume - volume
-				v_size = abs(v_diff)
-				v_sign = v_diff / v_size	# -1 or +1 
-				
-				# let's assume there will be many more pulses than tempo points 
-				# so issue a tempo event for tempo point change
-				pos = position
-				dur_incr = ramp_duration / v_size
-				for v in range(volume, new_volume, v_sign):
-					pos += dur_incr 
-					mk_volume_event(song, v, pos, track_num )
-				mk_volume_event(song, new_volume, position+ramp_duration, track_num)
-			volume = new_volume
-			ramp_duration = 0
-
-			i += offset
+				self.i += offset
+
+	#
+	# Duration modifiers...
+	#
+	def do_staccato(self, c):
+		self.staccato=True	# shorter note
+
+	def do_fermata(self, c):
+		self.fermata=True	# longer note (and measure)
+
+	def do_tie(self, c):
+		"""
+		Tie...
+		This one's a bit tricky as we've already created the event, but
+		here we just set the flag.  The Note code will deal with it
+		"""
+		self.tied[self.track_num] = True
+
+	#
+	# ------------------   Timing: tempo, time signature
+	#
+	def do_tempo(self, c):
+		"""
+		tempo is in "beats" per minute, where beats is the
+		current duration.  The value we store is microseconds per
+		quarter note.  So:
+		We take microseconds per minute, divide by tempo, then correct
+		with  a factor of a quarter note / current note...
+
+		If ramp_duration is set - we issue a series of events going forward in 
+		time (they'll be sorted into the correct order later).   If ramp_duration
+		is zero, we make one.  (tempo_events makes them.)
+		"""
+		try:
+			(new_tempo, offset)=getnum(self.text, self.i)
+		except ValueError, info:
+			#print "Expected to find a number for tempo,", info
+			return
+
+		self.i+=offset	# point to the next char...
+		if new_tempo == 0 or self.duration == 0:	# (e.g. a note shrunk to nothing by a big tuplet)
+			self.warn(out_utils.BAD_NUMBER, ("Tempo can't be 0, or in notes of no length:", new_tempo, self.duration))
+			return
 		
-		# Acceleration, deacceleration, crescendo, decrescendo...
-		elif c in '+-<>':	# handle some commonality (read the next value...)
-			try:
-				(num, offset) = getnum(text[i:])
-			except ValueError, info:
-				print "Expected value for modifier:", c, info
-			else:
-				# We can treat these all the same - just set the ramping value
-				# to the current note duration.  When the next volume or tempo change
-				# is hit, we process it then
-				i += offset
-				ramp_duration = duration * num
-				# We could distinguish between volume / tempo or increase / decrease
-				# but beyond generating a  warning - there's no real difference...	
-		#
-		# Grouping...  notes start at the same time...
-		elif c == '(':
-			grouping = True
-			#print "Grouping:", grouping
-			group_length = measure_length * 5 # (one bar *should* be the limit - this is plenty)
-		elif c == ')':
-			grouping = False
-			position += group_length
-			#print "Grouping:", grouping, ", new position:", position
-		elif c == 'N':	# voicing information per track...
-			(num, offset) = getnum(text[i:])
-			i += offset
-			#print "Voicing with value:", num
+		if self.ramp_duration and new_tempo == self.tempo:
+			#print "Warning: tempo ramp specified with no change: dur/tempo", ramp_duration, tempo, new_tempo
+			self.ramp_duration = 0
+			return	# no change
+		self.tempo_events(self.tempo, new_tempo, self.ramp_duration)
+		self.tempo = new_tempo
+		self.ramp_duration = 0
+
+	def tempo_events(self, tempo, new_tempo, ramp_duration):
+		"""
+		The event for a change to new_tempo - or with a ramp, a
+		series of them, from the current tempo up (or down) to it
+		"""
+		song = self.song
+		position = self.position
+		q_dur = self.note_durations['Q']	# duration of a quarter note
+		n_dur = self.duration			# duration of current note
+		if ramp_duration == 0:
+			mk_tempo_event(song, new_tempo, position, q_dur, n_dur)
+		else:
+			for (step, t) in ramp_points(tempo, new_tempo, ramp_duration, 
+					song.ramp_spacing, song.ramp_curve):
+				mk_tempo_event(song, t, position + step, q_dur, n_dur)
+
+	def do_time_signature(self, c):
+		"""
+		Time Signature (Meter) - generates an event...
+		meter change...  (n)n-m   where nn is numerator, m denom
+		"""
+		song = self.song
+		text = self.text
+		try:
+			(ts_num, offset) = getnum(text, self.i)
+		except ValueError, info:
+			ts_num=4
+			offset=0
+			self.warn(out_utils.BAD_NUMBER, ("Expected time signature number, got:", str, info),
+				("Assuming:", ts_num))
+
+		self.i += offset + 1 	# past the "-"
+		try:
+			(ts_denom, offset) = getnum(text, self.i)
+		except ValueError, info:
+			ts_denom=4
+			offset=0
+			self.warn(out_utils.BAD_NUMBER, ("Expected a time signature denominotor, got:", c),
+				("Assuming: 4",))
+
+		self.i += offset
+
+		if ts_num == 0 or ts_denom == 0 or self.note_durations['W'] * ts_num / ts_denom == 0:
+			# no length to a measure: a barline would never catch up
+			self.warn(out_utils.BAD_NUMBER, ("Time signature makes an empty measure:", ts_num, ts_denom),
+				("Assuming: 4-4",))
+			(ts_num, ts_denom) = (4, 4)
+
+		# set measure to the length of a whole note times the time signature
+		self.measure_length = self.note_durations['W'] * ts_num / ts_denom
+		self.time_signature_event(ts_num, ts_denom)
+
+	def time_signature_event(self, ts_num, ts_denom):
+		# now we get slightly tricky, the MFF wants us to emit
+		# four values, numerator, dnomingtaro (as a negative power of two: 2 => Q)
+		# MIDI clocks in a click
+		song = self.song
+		ts_event = songevents.Time_Signature()
+		ts_event.ppq = song.PPQ
+		ts_event.numerator = ts_num
+		ts_event.denominator = ts_denom
+		ts_event.pos = self.position
+		song.append(ts_event)		# add to the song
+
+	def do_measure(self, c):
+		"""
+		New measure - move the position forward... 
+		"""
+		position = self.position
+		newpos = self.last_measure + self.measure_length
 		
-		#
-		# Divisions...  corresponding to tracks...
-		elif c in DIVISIONS:
-			index=DIVISIONS.find(c)		# which one?
-			if song.format == 1:	
-				# have we seen this division/track yet?
-				if c not in track_list:
-					track_list += c
-					# Track number is the position in the list + 1
-					#print "New Division: ", DIV_NAMES[index], "track:", track_num, c
-					track = MFF.Track_Chunk()
-					track.name = DIV_NAMES[index]
-					song.track_list.append(track)
-					song.track_count += 1
-					track.track_num = song.track_count	# assign a number 
-					#print "Track count is:", song.track_count
-				
-				track_num = track_list.find(c) + 1
-				current_track = song.track_list[track_num]
-				#print "Track number set to:", track_num
-		#
-		# Orchestration...		
-		elif c == 'O':		# "orchestration -> program change"
-			try:
-				(pc, offset) = getnum(text[i:])
-			except ValueError, info:
-				print "Orchestration not a number", info
-			else:
-				# generate a program change...
-				#print "Orchestration / Program Change:", pc
-				last_o = pc	# not sure what, if anything, to do with this.
-			i += offset
-		#
-		#
-		# ------- Meta:  Comments, etc...
-		#
-		# Comment - generates an event
-		elif c == '"':
-			end=text[i:].find('"') + i	# position of the next " n the full text
-			comment_text=text[i:end]
-			#print "Comment: ", comment_text
-			i=end+1		# skip to the end of the comment
-			comment=songevents.Comment()
-			comment.pos = position
-			comment.data = comment_text
-			comment.track_num = 0	# comments always in track 0
-			#song.events += [ comment ]
-			song.append(comment)
-
-
-		# other 
-		elif c in IGNORE:
-			continue
-
-		elif c in STOP:
-			ended=True
-			#print "End Marker found."
-			break
+		if newpos > position:
+			self.warn(out_utils.SHORT_MEASURE, 
+				("Warning: position was short of new measure:", self.measure_num, position, newpos))
+			
+		while newpos < position:
+			self.warn(out_utils.LONG_MEASURE, ("Warning: current position:", position, 
+				"is greater than next measure/position:", self.measure_num, newpos))
+			newpos += self.measure_length + self.fermata_add	# keep adding to the measure pointer to catch up with position.
+			self.fermata_add = 0	# allows a one-time addition to a bar for the longest held note
+		
+		self.position = newpos
+		self.last_measure = newpos
+		
+		self.solo = False
+		self.measure_num += 1
+		# new measure resets all accidentals...
+		self.key_info.reset_accidentals()
+		self.clear_ties()
+		if self.stop_at is not None and self.i >= self.stop_at:
+			return True
+		if self.checkpoints is not None:
+			return self.checkpoint()
+
+	def do_restart(self, c):
+		"""
+		restart measure - reset position, clear accidentals
+		"""
+		barend = self.last_measure + self.measure_length
+		if self.position > barend:
+			self.warn(out_utils.LONG_RESTART, 
+				("Warning: restarted measure would be long: ",self.measure_num, self.position, barend))
+		self.position = self.last_measure
+		# new measure resets all accidentals...
+		self.key_info.reset_accidentals()
+		self.solo = False
+
+	def do_solo(self, c):
+		self.solo = True
+
+	#
+	# --------------  Misc:  volume, ramps, grouping, Divisions (tracks), orchestration 
+	#
+	def do_volume(self, c):
+		try:
+			(vol, offset) = getnum(self.text, self.i)
+		except ValueError, info:
+			self.warn(out_utils.BAD_NUMBER, ("No volume value found", info))
+			return
+		
+		new_volume = ( vol & 0x3f ) + 64 	# 0-63 maps to MIDI vol 64-127
+		self.volume_events(self.volume, new_volume, self.ramp_duration)
+		self.volume = new_volume
+		self.ramp_duration = 0
+
+		self.i += offset
+
+	def volume_events(self, volume, new_volume, ramp_duration):
+		"""
+		The event for a change to new_volume - or with a ramp, a 
+		series of them, each at the end of its step
+		"""
+		song = self.song
+		position = self.position
+		track_num = self.track_num
+		if ramp_duration == 0:
+			mk_volume_event(song,new_volume, position, track_num)
 		else:
-			print "Unrecognized: ", repr(c), "at:", position, '--------------------------------------------'
-			print text[i-30:i+31]
-			print "                 ----here----^"
-	if not ended:
-		print "Warning: file likely not properly terminated."
+			for (step, v) in ramp_points(volume, new_volume, ramp_duration, 
+					song.ramp_spacing, song.ramp_curve, late=True):
+				mk_volume_event(song, v, position + step, track_num)
 
-	
+	def do_ramp(self, c):
+		"""
+		Acceleration, deacceleration, crescendo, decrescendo...
+		We can treat these all the same - just set the ramping value
+		to the current note duration.  When the next volume or tempo change
+		is hit, we process it then
+		"""
+		try:
+			(num, offset) = getnum(self.text, self.i)
+		except ValueError, info:
+			self.warn(out_utils.BAD_NUMBER, ("Expected value for modifier:", c, info))
+		else:
+			self.i += offset
+			self.ramp_duration = self.duration * num
+			# We could distinguish between volume / tempo or increase / decrease
+			# but beyond generating a  warning - there's no real difference...	
+
+	def do_group_start(self, c):
+		"""
+		Grouping...  notes start at the same time...
+		"""
+		self.grouping = True
+		self.group_length = self.measure_length * 5 # (one bar *should* be the limit - this is plenty)
+
+	def do_group_end(self, c):
+		self.grouping = False
+		self.position += self.group_length
+
+	def do_voicing(self, c):
+		"""
+		voicing information per track... (ignored)
+		"""
+		try:
+			(num, offset) = getnum(self.text, self.i)
+		except ValueError, info:
+			self.warn(out_utils.BAD_NUMBER, ("Voicing not a number", info))
+		else:
+			self.i += offset
+
+	def do_division(self, c):
+		"""
+		Divisions...  corresponding to tracks...
+		"""
+		song = self.song
+		index=DIVISIONS.find(c)		# which one?
+		if song.format == 1:	
+			# have we seen this division/track yet?
+			if c not in self.track_list:
+				self.track_list += c
+				# Track number is the position in the list + 1
+				track = MFF.Track_Chunk()
+				track.name = DIV_NAMES[index]
+				self.add_track(track)
+				track.track_num = song.track_count	# assign a number 
+			
+			self.track_num = self.track_list.find(c) + 1
+
+	def do_orchestration(self, c):
+		"""
+		"orchestration -> program change"
+		"""
+		try:
+			(pc, offset) = getnum(self.text, self.i)
+		except ValueError, info:
+			self.warn(out_utils.BAD_NUMBER, ("Orchestration not a number", info))
+		else:
+			# generate a program change...
+			self.last_o = pc	# not sure what, if anything, to do with this.
+			self.i += offset
+
+	#
+	# ------- Meta:  Comments, etc...
+	#
+	def do_comment(self, c):
+		"""
+		Comment - generates an event
+		"""
+		(comment_text, end)=getcomment(self.text, self.i)
+		self.i=end+1		# skip to the end of the comment
+		comment=songevents.Comment()
+		comment.pos = self.position
+		comment.data = comment_text
+		comment.track_num = 0	# comments always in track 0
+		self.song.append(comment)
+
+	def do_stop(self, c):
+		self.ended=True
+		return True
+
+	def do_unrecognized(self, c):
+		text = self.text
+		i = self.i
+		self.diagnostics.warn(out_utils.UNRECOGNIZED, i - 1, self.measure_num,
+			("Unrecognized: ", repr(c), "at:", self.position, '--------------------------------------------'),
+			(spaced(text[i-30:i+31]),),
+			("                 ----here----^",))
+
+class NullSong(songevents.Song):
+	"""
+	A song that keeps nothing: for a Checker
+	"""
+	def append(self, event):
+		return event
+
+class Checker(Parser):
+	"""
+	Goes through the score keeping the parser's state - positions,
+	measure lengths, ties, tuplets, keys - but making no events: no
+	notes, no tempo, volume, key or time signature events, no key
+	work, nothing stored (give it a NullSong).  It gives the same
+	warnings a full parse would, in a fraction of the time.
+	"""
+	def do_note(self, c):
+		"""
+		Just what a note does to the state: the octave, the tie, the
+		accidental and fermata used up, the note-off's slot filled,
+		and the position moved on.
+		"""
+		track_num = self.track_num
+		try:
+			o = self.text[self.i]	# check for possible octave
+		except IndexError:	# the text ends on the note
+			o = ' '
+		if o in OCTAVES:
+			self.octave = int(o) + OCT_OFFSET
+			self.i += 1
+		elif self.octave is None:
+			self.octave = 5
+		slot = self.octave*12 + NOTES.find(c)
+
+		if self.tied[track_num]:
+			if self.noteoff_list[track_num][slot] != 'None':
+				self.tied[track_num] = False
+		else:
+			self.accidental = 'None'
+			if not self.staccato and self.fermata:
+				self.fermata_add = self.duration
+			self.noteoff_list[track_num][slot] = True
+		self.advance()
+
+	def do_comment(self, c):
+		self.i = getcomment(self.text, self.i)[1] + 1
+
+	def tempo_events(self, tempo, new_tempo, ramp_duration):
+		pass
+
+	def volume_events(self, volume, new_volume, ramp_duration):
+		pass
+
+	def time_signature_event(self, ts_num, ts_denom):
+		pass
+
+	def key_event(self):
+		pass
+
+#
+# Ramps:  tempo and volume changes spread over a duration
+#
+# How the value moves from start to end: x is how far through the
+# ramp we are (0 - 1), the result how far the value has moved (0 - 1)
+RAMP_CURVES = {
+	'linear': lambda x: x,
+	'exp': lambda x: x * x,			# slow start, fast finish
+	'log': lambda x: 1 - (1 - x) * (1 - x),	# fast start, slow finish
+	'scurve': lambda x: x * x * (3 - 2 * x),	# slow at both ends
+	}
+
+def ramp_points(start, end, duration, spacing=0, curve='linear', late=False):
+	"""
+	The steps of a ramp from start to end over duration pulses: a list
+	of (offset, value) tuples, offset from the start of the ramp.  The 
+	last step is always to end (at duration, unless the curve gets
+	there sooner).
+
+	With no spacing and a linear curve, we do what we always did: one 
+	step for each value between start and end, evenly spaced (by an 
+	integer division, so a big change over a short ramp can pile up 
+	several steps on the same pulse).  late puts each step at the end 
+	of its slot rather than the beginning (how volume ramps work).
+
+	Otherwise the curve (see RAMP_CURVES) gives the values, and 
+	spacing is the fewest pulses allowed between steps - a ramp gets
+	no more steps than fit.  Steps that round to the same value as the
+	one before are dropped.
+	"""
+	size = abs(end - start)
+	if size == 0:
+		return [ (duration, end) ]
+
+	shape = RAMP_CURVES[curve]
+	if spacing <= 0 and shape == RAMP_CURVES['linear']:
+		sign = (end - start) / size	# -1 or +1 
+		incr = duration / size
+		points = []
+		for (k, value) in enumerate(range(start, end, sign)):
+			if late:
+				k += 1
+			points.append((k * incr, value))
+		points.append((duration, end))
+		return points
+
+	steps = size
+	if spacing > 0:
+		steps = max(1, min(size, duration / spacing))
+	if late:
+		slots = range(1, steps + 1)
+		last = start	# already there - no need to say it again
+	else:
+		slots = range(steps + 1)
+		last = None
+	points = []
+	for k in slots:
+		value = start + int(round((end - start) * shape(float(k) / steps)))
+		if value != last:
+			points.append((duration * k / steps, value))
+			last = value
+	return points
+
+def score_bytes(source):
+	"""
+	The score as a string, just as it is, from an open file (or 
+	anything else with a read()), or a string/buffer of the score 
+	itself (a bytearray, memoryview, ...).
+	"""
+	if hasattr(source, 'read'):
+		return source.read()
+	if isinstance(source, memoryview):
+		return source.tobytes()
+	return str(source)
+
+def read_score(source):
+	"""
+	The score ready to parse (see score_bytes).  There's nothing to
+	do to it any more: the parser skips cr/lf itself.
+	"""
+	return score_bytes(source)
+
+def map_score(infile):
+	"""
+	The score in an open file, ready to parse, without reading it in:
+	the file mapped into memory.  (The parser only needs to index, 
+	slice and find() the text - an mmap does all that.)  Anything that
+	can't be mapped - an empty file, a pipe, a file-like object - is
+	read in as usual.
+	"""
+	try:
+		return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+	except (AttributeError, ValueError, EnvironmentError):
+		return read_score(infile)
+
+def parse_text(text, song, profile=None, diagnostics=None, quiet=False):
+	"""
+	Parse the text of a score into the song.  Nothing here touches
+	the file system.  With a profile (see profiling.py), the 
+	commands are counted as they're parsed.  Warnings go to 
+	diagnostics (see Parser) - with none given, they're printed 
+	(as many as out_utils.MAX_PER_KIND of a kind), and then how 
+	many weren't.  quiet: don't say where the song ended up.
+	"""
+	ours = diagnostics is None
+	if ours:
+		diagnostics = out_utils.Diagnostics()
+	parser = Parser(song, diagnostics=diagnostics)
+	if profile is not None:
+		profile.instrument(parser)
+	parser.parse(text)
+
+	if not parser.ended:
+		parser.warn(out_utils.UNTERMINATED, ("Warning: file likely not properly terminated.",))
+	if ours:
+		diagnostics.summary()
+
+	if not quiet:
+		print "Final position:", parser.position
+		print "Measures:", parser.measure_num
+
+def lint_text(text, diagnostics=None, ppq=192):
+	"""
+	Check the text of a score without converting it: the warnings a
+	parse at this PPQ would give go to diagnostics - by default, a 
+	new one that just keeps them (see out_utils.Diagnostics).  Returns
+	diagnostics.
+	"""
+	if diagnostics is None:
+		diagnostics = out_utils.Diagnostics(echo=False)
+	song = NullSong()
+	song.format = 1
+	song.PPQ = ppq
+	song.time_factor = 1
+	checker = Checker(song, diagnostics=diagnostics)
+	checker.parse(text)
+	if not checker.ended:
+		checker.warn(out_utils.UNTERMINATED, ("Warning: file likely not properly terminated.",))
+	return diagnostics
 
-	print "Final position:", position
-	print "Measures:", song.measure_num
+def lint(filename, diagnostics=None, ppq=192):
+	"""
+	Check a score file (or an open file) - see lint_text
+	"""
+	if hasattr(filename, 'read'):
+		text = map_score(filename)
+	else:
+		infile = open(filename, 'rb')
+		text = map_score(infile)
+		infile.close()
 
+	try:
+		return lint_text(text, diagnostics, ppq)
+	finally:
+		if isinstance(text, mmap.mmap):
+			text.close()
+
+def parse_song(filename, song, profile=None, diagnostics=None):
+	"""
+	We map the file into memory (see map_score) and then step 
+	through it, handing each character to the parser.  No copy of
+	the file is made.
+
+	At the end we have a song object that contains a long 
+	list of events: notes, tempo changes, comments, etc.
+
+	filename can also be an already open file.  profile and 
+	diagnostics: see parse_text.
+	"""
+	if hasattr(filename, 'read'):
+		text = map_score(filename)
+	else:
+		infile = open(filename, 'rb')
+		text = map_score(infile)	# the entire file
+		infile.close()		# (the map keeps its own hold on the file)
+
+	try:
+		parse_text(text, song, profile, diagnostics)
+	finally:
+		if isinstance(text, mmap.mmap):
+			text.close()
+
+
+"""
+Debug:
+"""
+def check_accidentals():
+	"""
+	Accidentals carry on to later notes in the same measure (and the 
+	note-offs have to match the notes), a barline clears them.
+	"""
+	song = songevents.Song()
+	song.format = 1
+	song.PPQ = 192
+	song.time_factor = 1
+	parser = Parser(song)
+	#            F#  F#  G   Bb  Bb     F   Bb    (barline)  F   B   C#  C#     Bb (key 1!)
+	parser.parse("U I #F4 F  G  !B  B   %F  B R / F  B #C5 C  K1! B R R R / Z")
+	expected = [ 66, 66, 67, 70, 70, 65, 70,      65, 71, 73, 73,     82 ]
+
+	notes = []
+	sounding = {}
+	for event in song.all_events():
+		if event.type == 'NOTE':
+			notes.append(event.note_num)
+			sounding[event.note_num] = sounding.get(event.note_num, 0) + 1
+		elif event.type == 'NOTEOFF':
+			if not sounding.get(event.note_num):
+				print "Note-off without a note:", event.note_num, "at", event.pos
+				return False
+			sounding[event.note_num] -= 1
+	if notes != expected:
+		print "Accidentals wrong:", notes, "expected", expected
+		return False
+	print "Accidentals OK"
+	return True
+
+def check_reentrant():
+	"""
+	Two parses going at once (a step of one, a step of the other)
+	have to come out the same as one after the other, and a song
+	has to come out the same each time it's written - even when
+	it's written from several threads at once.
+	"""
+	import io
+	import StringIO
+	import threading
+	texts = [ 'U H #F4 & F / : Q C3 E G & G / Z',
+		'$3-4 K2# U Q F C & C / J %F #C5 R / Z' ]
+	songs = []
+	parsers = []
+	for text in texts:
+		song = songevents.Song()
+		song.format = 1
+		song.PPQ = 192
+		song.time_factor = 1
+		songs.append(song)
+		parsers.append(Parser(song))
+		parsers[-1].text = text
+		parsers[-1].i = 0
+	while [ p for p in parsers if p.i < len(p.text) and not p.ended ]:
+		for p in parsers:
+			if p.i < len(p.text) and not p.ended:
+				c = p.text[p.i]
+				p.i += 1
+				if p.dispatch[c] is not None and p.dispatch[c](c):
+					p.ended = True
+
+	for (text, song) in zip(texts, songs):
+		outputs = []
+		for n in range(2):
+			outfile = io.BytesIO()
+			song.create_MFF(outfile, None)
+			outputs.append(outfile.getvalue())
+		alone = songevents.Song()
+		alone.format = 1
+		alone.PPQ = 192
+		alone.time_factor = 1
+		Parser(alone).parse(text)
+		outfile = io.BytesIO()
+		alone.create_MFF(outfile, None)
+		if outputs[0] != outputs[1]:
+			print "Song came out different the second time:", text
+			return False
+		if outputs[0] != outfile.getvalue():
+			print "Interleaved parse came out different:", text
+			return False
+
+	# tempo, key and time signature events, written by 8 threads at once
+	text = "=90 U " + "$3-4 K2# Q F C =100 A / $6-8 K1! =110 I C D E F G A / " * 200 + "Z"
+	song = songevents.Song()
+	song.format = 1
+	song.PPQ = 192
+	song.time_factor = 1
+	Parser(song).parse(text)
+	expected = io.BytesIO()
+	song.create_MFF(expected, None)
+	outputs = []
+	def render():
+		for n in range(3):
+			outfile = io.BytesIO()
+			song.create_MFF(outfile, None)
+			outputs.append(outfile.getvalue())
+	threads = [ threading.Thread(target=render) for n in range(8) ]
+	interval = sys.getcheckinterval()
+	stdout = sys.stdout
+	sys.stdout = StringIO.StringIO()	# (the track counts)
+	sys.setcheckinterval(1)		# switch threads as often as possible
+	try:
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	finally:
+		sys.setcheckinterval(interval)
+		sys.stdout = stdout
+	bad = len([ output for output in outputs if output != expected.getvalue() ])
+	if bad:
+		print "Threaded writes came out different:", bad, "of", len(outputs)
+		return False
+	print "Re-entrant OK"
+	return True
+
+def check_rescale():
+	"""
+	A song parsed at 192 PPQ and rescaled to 480 (and a new time
+	factor) comes out as if it was parsed that way; the original 
+	isn't changed.
+	"""
+	import io
+	text = "=90 U Q C4 ^D I E F '3 I G A B ' / H D & D / : Q C3 R R R / Z"
+	outputs = {}
+	for (ppq, factor) in (192, 1), (480, 1.1268):
+		song = songevents.Song()
+		song.format = 1
+		song.PPQ = ppq
+		song.time_factor = factor
+		Parser(song).parse(text)
+		outputs[ppq] = song
+	before = io.BytesIO()
+	outputs[192].create_MFF(before, None)
+	rescaled = io.BytesIO()
+	outputs[192].rescale(480, 1.1268).create_MFF(rescaled, None)
+	parsed = io.BytesIO()
+	outputs[480].create_MFF(parsed, None)
+	after = io.BytesIO()
+	outputs[192].create_MFF(after, None)
+	if rescaled.getvalue() != parsed.getvalue():
+		print "Rescaled song differs from one parsed at 480"
+		return False
+	if before.getvalue() != after.getvalue():
+		print "Rescaling changed the original song"
+		return False
+	print "Rescale OK"
+	return True
+
+def check_lint():
+	"""
+	lint finds just what a full parse does - the same warnings, at
+	the same places
+	"""
+	text = "=90 U Q C4 D E F G / H C & / ~5 V30 I C D E F '3 I G A B ' x / Q C ^ W C / : H C5 R"
+	song = songevents.Song()
+	song.format = 1
+	song.PPQ = 192
+	song.time_factor = 1
+	parsed = out_utils.Diagnostics(echo=False)
+	parser = Parser(song, diagnostics=parsed)
+	parser.parse(text)
+	parser.warn(out_utils.UNTERMINATED, ("Warning: file likely not properly terminated.",))
+	linted = lint_text(text)
+	found = [ (w.kind, w.offset, w.measure, w.lines) for w in linted.warnings ]
+	if found != [ (w.kind, w.offset, w.measure, w.lines) for w in parsed.warnings ] or len(found) < 4:
+		print "Lint found different warnings:", linted.warnings, parsed.warnings
+		return False
+	print "Lint OK"
+	return True
 
 def main():
-	print "No debug at this time"
+	check_accidentals()
+	check_reentrant()
+	check_rescale()
+	check_lint()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+	Where does a conversion's time go?  uph2mff --profile fills in a
+	Profile and prints it at the end:
+		- wall and CPU time for each phase: read, parse (and how much
+		  of that was key adjustment), optimize, sort, emit, post
+		- how many events of each type the song has
+		- how often each parser command was used
+		- the bytes written for each track
+
+	Nothing here is in the way when profiling is off: the counters
+	are wrapped around the parser's handlers (and the key adjustment)
+	only for a parse that's being profiled, and the phases are timed
+	a handful of times per file.  NO_PROFILE stands in for a Profile
+	when there isn't one - its phases do nothing.
+"""
+
+import time
+
+import songevents
+
+class Phase():
+	"""
+	Times one phase (use in a with), adding it to the profile
+	"""
+	def __init__(self, profile, name):
+		self.profile = profile
+		self.name = name
+
+	def __enter__(self):
+		self.wall = time.time()
+		self.cpu = time.clock()
+
+	def __exit__(self, *args):
+		self.profile.add(self.name, time.time() - self.wall, time.clock() - self.cpu)
+
+class NoPhase():
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *args):
+		pass
+
+class NoProfile():
+	"""
+	Not profiling: the same calls, doing nothing
+	"""
+	def phase(self, name):
+		return NO_PHASE
+
+NO_PHASE = NoPhase()
+NO_PROFILE = NoProfile()
+
+class Profile():
+	def __init__(self):
+		self.order = []		# phase names, in the order first seen
+		self.times = {}		# phase name -> [ wall, cpu ]
+		self.commands = {}	# command character -> times used
+		self.key_time = 0	# seconds in key adjustment
+		self.tracks = []	# (output, track name, bytes) per track written
+		self.output = None	# the file being written
+		self.events = {}	# event type -> count
+
+	def phase(self, name):
+		return Phase(self, name)
+
+	def add(self, name, wall, cpu):
+		"""
+		Time for a phase (added on, if it's already been seen)
+		"""
+		if name not in self.times:
+			self.order.append(name)
+			self.times[name] = [ 0, 0 ]
+		self.times[name][0] += wall
+		self.times[name][1] += cpu
+
+	def instrument(self, parser):
+		"""
+		Count the parser's commands, and time its key adjustment
+		"""
+		dispatch = parser.dispatch
+		for (c, handler) in dispatch.items():
+			if handler is not None:
+				dispatch[c] = self.counted(c, handler)
+		parser.key_info.adjust = self.timed(parser.key_info.adjust)
+
+	def counted(self, c, handler):
+		commands = self.commands
+		commands[c] = 0
+		def count(c):
+			commands[c] += 1
+			return handler(c)
+		return count
+
+	def timed(self, adjust):
+		def timed_adjust(note):
+			start = time.time()
+			adjust(note)
+			self.key_time += time.time() - start
+		return timed_adjust
+
+	def track(self, name, length):
+		self.tracks.append((self.output, name, length))
+
+	def count_events(self, song):
+		"""
+		Events in the song by type
+		"""
+		events = {}
+		for store in song.track_events:
+			for (code, name) in (songevents.NOTE_ON, 'NOTE'), (songevents.NOTE_OFF, 'NOTEOFF'):
+				events[name] = events.get(name, 0) + store.code.count(code)
+			for event in store.objects:
+				if event is not None:
+					events[event.type] = events.get(event.type, 0) + 1
+		self.events = events
+
+	def report(self):
+		print "Profile:"
+		print "  %-12s %10s %10s" % ("Phase", "Wall", "CPU")
+		total = [ 0, 0 ]
+		for name in self.order:
+			(wall, cpu) = self.times[name]
+			print "  %-12s %10.3f %10.3f" % (name, wall, cpu)
+			if name == 'parse' and self.key_time:
+				print "  %-12s %10.3f" % ("  key adjust", self.key_time)
+			total[0] += wall
+			total[1] += cpu
+		print "  %-12s %10.3f %10.3f" % ("total", total[0], total[1])
+
+		if self.events:
+			print "Events: %d" % sum(self.events.values())
+			for (count, name) in sorted([ (-count, name) for (name, count) in self.events.items() ]):
+				print "  %-16s %10d" % (name, -count)
+
+		used = [ (-count, c) for (c, count) in self.commands.items() if count ]
+		if used:
+			print "Commands: %d" % -sum([ count for (count, c) in used ])
+			for (count, c) in sorted(used):
+				print "  %-16r %10d" % (c, -count)
+
+		output = None
+		n = 0
+		for (track_output, name, length) in self.tracks:
+			if n == 0 or track_output != output:
+				output = track_output
+				n = 0
+				print "Track bytes: %d%s" % (sum([ t[2] for t in self.tracks if t[0] == output ]),
+					"" if output is None else " - " + output)
+			print "  %2d %-26s %10d" % (n, name, length)
+			n += 1
+
+"""
+Debug:
+"""
+def main():
+	import io
+	import parse
+	profile = Profile()
+	song = songevents.Song()
+	song.format = 1
+	song.PPQ = 192
+	song.time_factor = 1
+	with profile.phase('parse'):
+		parse.parse_text("=90 U V20 Q C4 #D E & E / : \"hi\" I G A B C5 H R / Z", song, profile)
+	profile.count_events(song)
+	outfile = io.BytesIO()
+	song.create_MFF(outfile, None, profile)
+	profile.report()
+	if profile.commands['C'] != 2 or profile.events['NOTE'] != 7 or profile.events['NOTEOFF'] != 7:
+		print "Counts wrong:", profile.commands, profile.events
+	elif sum([ length + 8 for (output, name, length) in profile.tracks ]) + 14 != len(outfile.getvalue()):
+		print "Track bytes don't add up to the file"
+	else:
+		print "Profile OK"
+
+
+if __name__ == "__main__":
+	main()
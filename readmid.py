@@ -1,87 +1,386 @@
 #!/usr/bin/env python
-"""  A quick and dirty attempt to break down a MFF
 """
+	Read a Standard MIDI File back in - to look at what we wrote, or
+	to check it over.
 
-def value(string):
-	i = 0
-	for c in string:
-		i *= 256
-		i += ord(c)
-	return(i)
+	The file is read once, into a bytearray (indexing gives the byte
+	values straight off - no ord() of one character strings), and
+	everything else is a slice of a memoryview of it: nothing is copied.
 
-def get_vlq(v):
-	i=0
+	Opening a file only finds the chunks (the header, and where each
+	track starts and ends) - a track is decoded when its events are
+	asked for, an event at a time, so a track that isn't wanted costs
+	nothing.  read_header() reads just the header.
 
-	value = 0
-	n = 0x80
-	while n & 0x80:	# keep going while the bit is set
-		n = ord(v[i])
-		value = value << 7
-		value += n & 0x7f
-		i += 1
-	return ( [value, i] )
+	Events come back as tuples: (tick, status, a, b)
+		channel messages:	a, b the data bytes (b is None for
+					program change and channel pressure)
+		meta events:		status 0xff, a the meta type, b the data
+		sysex:			status 0xf0 or 0xf7, a None, b the data
+	tick is the absolute time, in pulses from the start of the track.
+	The data is a memoryview: .tobytes() for a string.
 
+	validate() goes through the whole file and returns a list of what's
+	wrong with it (none, we hope).
 
-def main():
-	filename="testout.mid"
+	Run as a script: dump a file's events, or with -v, check any
+	number of files (or directories of them) and say how fast.
+"""
+
+import os
+import sys
+import time
+import struct
 
-	file = open(filename, 'r')
+from optparse import OptionParser
 
-	text = file.read()
+from MFF import unvlq
 
-	total_length=len(text)
-	print "Total length:", total_length
+CHUNK_HEADER = struct.Struct('>4sL')	# type, length
+HEADER = struct.Struct('>HHH')		# format, tracks, division
 
-	i=0
+META = 0xff
+SYSEX = 0xf0
+SYSEX_MORE = 0xf7
+END_OF_TRACK = 0x2f
 
-	while i < total_length:
-		header=text[i:i+4]
-		i += 4
+# data bytes for each kind of channel message (the status' high nibble)
+DATA_BYTES = { 0x80: 2, 0x90: 2, 0xa0: 2, 0xb0: 2, 0xc0: 1, 0xd0: 1, 0xe0: 2 }
 
-		lenstr=text[i:i+4]
-		i += 4
+MESSAGE_NAMES = { 0x80: 'Note off', 0x90: 'Note on', 0xa0: 'Key pressure',
+	0xb0: 'Control change', 0xc0: 'Program change', 0xd0: 'Channel pressure',
+	0xe0: 'Pitch bend' }
 
-		length = value(lenstr)
-		print "\nheader:", header
-		print "length:", length
+META_NAMES = { 0x00: 'Sequence number', 0x01: 'Text', 0x02: 'Copyright',
+	0x03: 'Track name', 0x04: 'Instrument', 0x05: 'Lyric', 0x06: 'Marker',
+	0x07: 'Cue point', 0x20: 'Channel prefix', 0x2f: 'End of track',
+	0x51: 'Tempo', 0x54: 'SMPTE offset', 0x58: 'Time signature',
+	0x59: 'Key signature', 0x7f: 'Sequencer specific' }
 
-		print "Content:"
+def read_header(filename):
+	"""
+	Just the header of a MIDI file: (format, tracks, division)
+	"""
+	infile = open(filename, 'rb')
+	data = infile.read(CHUNK_HEADER.size + HEADER.size)
+	infile.close()
+	if len(data) < CHUNK_HEADER.size + HEADER.size:
+		raise ValueError("File too short for a header: %d bytes" % len(data))
+	(kind, length) = CHUNK_HEADER.unpack_from(data)
+	if kind != 'MThd' or length < HEADER.size:
+		raise ValueError("Not a MIDI file: starts %r" % data[:4])
+	return HEADER.unpack_from(data, CHUNK_HEADER.size)
 
-		if header == 'MThd':
-			for n in range(length):
-				print " %02x" % ord(text[i+n]),
+def read_midi(filename):
+	"""
+	Read a MIDI file (a name, or an open file) into a MidiFile
+	"""
+	if hasattr(filename, 'read'):
+		return MidiFile(bytearray(filename.read()))
+	infile = open(filename, 'rb')
+	data = bytearray(os.fstat(infile.fileno()).st_size)
+	infile.readinto(data)		# straight in - no string in between
+	infile.close()
+	return MidiFile(data)
+
+class MidiFile():
+	"""
+	A MIDI file, read in.  format, tracks and division are from the
+	header; chunks is (type, start, length) for every chunk after it,
+	track_chunks the ones that are tracks.
+	"""
+	def __init__(self, data):
+		if not isinstance(data, bytearray):
+			data = bytearray(data)
+		self.data = data
+		self.view = memoryview(data)
+		if len(data) < CHUNK_HEADER.size + HEADER.size:
+			raise ValueError("File too short for a header: %d bytes" % len(data))
+		(kind, length) = CHUNK_HEADER.unpack_from(data)
+		if kind != 'MThd' or length < HEADER.size:
+			raise ValueError("Not a MIDI file: starts %r" % str(data[:4]))
+		(self.format, self.tracks, self.division) = HEADER.unpack_from(data, CHUNK_HEADER.size)
+
+		self.chunks = []
+		self.truncated = False		# the last chunk runs past the end of the file
+		i = CHUNK_HEADER.size + length
+		while i + CHUNK_HEADER.size <= len(data):
+			(kind, length) = CHUNK_HEADER.unpack_from(data, i)
+			i += CHUNK_HEADER.size
+			if i + length > len(data):
+				self.truncated = True
+				length = len(data) - i
+			self.chunks.append((kind, i, length))
 			i += length
-			continue
-			
-
-		event = text[i:i+length]
-		j=0
-		while j < length:
-			(val, off) = vlq(event[j])
-			j += off
-		
-			event_type = event[j]
-			if event_type == 0xff:
-				print "Meta-event:"
-				etype == event[j+1]
-				[ elen, off ] = vlq(event[2:])
-				j += off
-				print "elen = ", elen
-				print "Comment", text[j:j+eln]
-			
-	
-				i += elen
+		self.trailing = len(data) - i	# bytes after the last chunk
+		self.track_chunks = [ chunk for chunk in self.chunks if chunk[0] == 'MTrk' ]
+
+	def track_data(self, n):
+		"""
+		Track n's data, as a memoryview
+		"""
+		(kind, start, length) = self.track_chunks[n]
+		return self.view[start:start + length]
+
+	def events(self, n):
+		"""
+		Track n's events, one at a time (see above for what they
+		look like).  Raises ValueError if the track doesn't make sense.
+		"""
+		data = self.data
+		view = self.view
+		(kind, i, length) = self.track_chunks[n]
+		end = i + length
+		tick = 0
+		status = None
+		try:
+			while i < end:
+				b = data[i]		# the delta time, vlq
+				i += 1
+				delta = b & 0x7f
+				while b & 0x80:
+					b = data[i]
+					i += 1
+					delta = (delta << 7) | (b & 0x7f)
+				tick += delta
+
+				b = data[i]
+				if b & 0x80:
+					status = b
+					i += 1
+				elif status is None:
+					raise ValueError("Data byte 0x%02x with no status at %d" % (b, i))
+
+				if status < 0xf0:
+					if DATA_BYTES[status & 0xf0] == 2:
+						yield (tick, status, data[i], data[i + 1])
+						i += 2
+					else:
+						yield (tick, status, data[i], None)
+						i += 1
+				elif status == META:
+					meta = data[i]
+					(length, i) = unvlq(data, i + 1)
+					yield (tick, META, meta, view[i:i + length])
+					i += length
+					status = None	# no running status after a meta event...
+				elif status == SYSEX or status == SYSEX_MORE:
+					(length, i) = unvlq(data, i)
+					yield (tick, status, None, view[i:i + length])
+					i += length
+					status = None	# ... or a sysex
+				else:
+					raise ValueError("Bad status byte 0x%02x at %d" % (status, i - 1))
+		except IndexError:
+			raise ValueError("Track %d runs past the end of its chunk" % n)
+		if i > end:
+			raise ValueError("Track %d runs past the end of its chunk" % n)
+
+	def validate(self):
+		"""
+		Check the whole file.  Returns a list of problems - empty if
+		there aren't any.
+		"""
+		problems = []
+		if self.format not in (0, 1, 2):
+			problems.append("Unknown format: %d" % self.format)
+		if self.tracks != len(self.track_chunks):
+			problems.append("Header says %d tracks, found %d" % (self.tracks, len(self.track_chunks)))
+		if self.format == 0 and len(self.track_chunks) != 1:
+			problems.append("Format 0 with %d tracks" % len(self.track_chunks))
+		if self.truncated:
+			problems.append("Last chunk cut short")
+		if self.trailing:
+			problems.append("%d bytes after the last chunk" % self.trailing)
+
+		for n in range(len(self.track_chunks)):
+			sounding = {}		# (channel, note) -> notes on
+			ended = False
+			try:
+				for (tick, status, a, b) in self.events(n):
+					if ended:
+						problems.append("Track %d: events after the end of track" % n)
+						break
+					kind = status & 0xf0
+					if status < 0xf0 and (a > 0x7f or (b is not None and b > 0x7f)):
+						problems.append("Track %d: data byte out of range at %d" % (n, tick))
+					if kind == 0x90 and b:
+						key = (status, a)
+						sounding[key] = sounding.get(key, 0) + 1
+					elif kind == 0x80 or kind == 0x90:
+						key = (status | 0x10, a)
+						if sounding.get(key):
+							sounding[key] -= 1
+						else:
+							problems.append("Track %d: note-off with no note on, note %d at %d" % (n, a, tick))
+					elif status == META and a == END_OF_TRACK:
+						ended = True
+			except ValueError, info:
+				problems.append(str(info))
+				continue
+			if not ended:
+				problems.append("Track %d: no end of track" % n)
+			left = sum(sounding.values())
+			if left:
+				problems.append("Track %d: %d notes never turned off" % (n, left))
+		return problems
 
+def describe(event):
+	"""
+	One line for an event
+	"""
+	(tick, status, a, b) = event
+	if status == META:
+		data = b.tobytes()
+		name = META_NAMES.get(a, 'Meta 0x%02x' % a)
+		if 0x01 <= a <= 0x07:
+			return "%8d  %-18s %r" % (tick, name, data)
+		return "%8d  %-18s %s" % (tick, name, ' '.join([ '%02x' % ord(c) for c in data ]))
+	if status >= 0xf0:
+		return "%8d  %-18s %d bytes" % (tick, 'Sysex', len(b))
+	name = MESSAGE_NAMES[status & 0xf0]
+	if b is None:
+		return "%8d  %-18s ch %2d  %3d" % (tick, name, status & 0x0f, a)
+	return "%8d  %-18s ch %2d  %3d %3d" % (tick, name, status & 0x0f, a, b)
+
+def dump(filename):
+	midi = read_midi(filename)
+	print "Format %d, %d tracks, division %d" % (midi.format, midi.tracks, midi.division)
+	for n in range(len(midi.track_chunks)):
+		print
+		print "Track %d: %d bytes" % (n, len(midi.track_data(n)))
+		for event in midi.events(n):
+			print describe(event)
+
+def find_files(args):
+	"""
+	The files on the runstring - directories are searched for .mid
+	"""
+	files = []
+	for arg in args:
+		if os.path.isdir(arg):
+			for (dirpath, dirnames, filenames) in os.walk(arg):
+				dirnames.sort()
+				files += [ os.path.join(dirpath, name) for name in sorted(filenames)
+					if name.lower().endswith('.mid') ]
 		else:
-			print "Event: %02x" % ord(event_type)
+			files.append(arg)
+	return files
 
-			for n in range(length):
-				print " %02x" % ord(text[i+n]),
+def validate_files(files, quiet=False):
+	"""
+	Check each file, print what's wrong.  Returns the number of bad files.
+	"""
+	start = time.time()
+	bad = 0
+	for filename in files:
+		try:
+			problems = read_midi(filename).validate()
+		except (ValueError, IOError), info:
+			problems = [ str(info) ]
+		if problems:
+			bad += 1
+			print "%s:" % filename
+			for problem in problems:
+				print "\t" + problem
+		elif not quiet:
+			print "%s: OK" % filename
+	elapsed = time.time() - start
+	print "%d files, %d bad, %.3f seconds (%.0f files/second)" % (
+		len(files), bad, elapsed, len(files) / elapsed if elapsed else 0)
+	return bad
 
-			i += length
+"""
+Debug:
+"""
+def check():
+	"""
+	Write songs every way we can, read them back: they should check
+	out, and have the notes that went in.
+	"""
+	import io
+	import parse
+	import songevents
+	text = "=90 U Q C4 ^D I E F '3 I G A B ' / H D & D / : \"hi\" Q C3 R V20 #F R / Z"
+	for (format, running_status, zero_note_offs) in (1, False, False), (1, True, False), (1, True, True), (0, False, False):
+		song = songevents.Song()
+		song.format = format
+		song.PPQ = 192
+		song.time_factor = 1
+		song.running_status = running_status
+		song.zero_note_offs = zero_note_offs
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+		try:
+			parse.Parser(song).parse(text)
+			outfile = io.BytesIO()
+			song.create_MFF(outfile, None)
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+		midi = MidiFile(outfile.getvalue())
+		problems = midi.validate()
+		if problems:
+			print "Problems reading back a song:", format, running_status, zero_note_offs, problems
+			return False
+		notes = [ (tick, a) for n in range(midi.tracks) for (tick, status, a, b) in midi.events(n)
+			if status & 0xf0 == 0x90 and b ]
+		expected = [ (event.pos, event.note_num) for event in song.all_events() if event.type == 'NOTE' ]
+		if sorted(notes) != sorted(expected):
+			print "Notes read back wrong:", format, running_status, zero_note_offs
+			return False
+	if not MidiFile(outfile.getvalue()[:-5]).validate():
+		print "Cut short, but nothing wrong"
+		return False
+	song = songevents.Song()	# B9 is note 131: past what MIDI can say
+	song.format = 1
+	song.PPQ = 192
+	song.time_factor = 1
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		parse.Parser(song).parse("U Q B9 C9 D0 R / Z")
+		outfile = io.BytesIO()
+		song.create_MFF(outfile, None)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+	if not [ p for p in MidiFile(outfile.getvalue()).validate() if "out of range" in p ]:
+		print "Note out of range, but nothing wrong"
+		return False
+	print "MIDI read back OK"
+	return True
+
+def getoptions():
+	parser = OptionParser(usage="%prog [options] file.mid ...")
+	parser.add_option("-v", "--validate", dest="validate", action="store_true",
+	help="check the files (directories: every .mid in them) rather than dump them", default=False)
 
-		print "\n-----"
+	parser.add_option("-q", "--quiet", dest="quiet", action="store_true",
+	help="with -v, only mention the bad ones", default=False)
 
+	parser.add_option("-H", "--header", dest="header", action="store_true",
+	help="just the header", default=False)
+
+	parser.add_option("-s", "--self-check", dest="self_check", action="store_true",
+	help="write some songs, check they read back", default=False)
+
+	return parser.parse_args()
+
+def main():
+	(options, args) = getoptions()
+	if options.self_check:
+		check()
+		return
+	if not args:
+		args = [ 'testout.mid' ]
+	if options.validate:
+		sys.exit(1 if validate_files(find_files(args), options.quiet) else 0)
+	for filename in args:
+		if options.header:
+			print "%s: format %d, %d tracks, division %d" % ((filename,) + read_header(filename))
+		else:
+			dump(filename)
 
 
 if __name__ == "__main__":
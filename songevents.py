@@ -5,42 +5,134 @@
 	to creating MIDI File Format data.  Part of the Unplayed by Human Hands
 	project of Prentiss Knowlton.
 """
+import heapq
+import copy
+import operator
+from itertools import izip, imap
+from fractions import gcd
+from array import array
+
 import MFF
-import key
 
-def poskey(self):
-	return (self.pos)	# lets us sort events based on the position
+def scale(pos, old, new):
+	"""
+	A position at old PPQ, moved to new PPQ - exact if it can be, 
+	else rounded to the nearest pulse
+	"""
+	return (pos * new * 2 + old) // (old * 2)
+
+def scale_off(pos, old, new):
+	"""
+	The same for a note-off: most of them end a pulse short of a 
+	beat (to keep from colliding with the next note) - those stay a 
+	pulse short of where the beat moves to.  They're the ones where 
+	the next pulse lines up better with the beat than they do.
+	"""
+	if gcd(pos + 1, old) > gcd(pos, old):
+		return scale(pos + 1, old, new) - 1
+	return scale(pos, old, new)
+
+# What's in each row of an EventStore..
+NOTE_ON = 0
+NOTE_OFF = 1
+OBJECT = 2	# anything else: the event object itself is kept
 
 class Song:
 	""" 
-	Basically aA list of events (note, comment, etc.) and sorted list function.
+	Basically a list of events (note, comment, etc.) for each track,
+	and a sorted list function.
+
+	Events are kept per track - within a track they arrive nearly
+	in order (note-offs and ramps are the exceptions), so each track 
+	sorts quickly on its own and can be emitted on its own.  There's
+	no need to sort every event in the song together.
+
+	Once parsed, a song isn't changed by emitting it: each emit
+	builds fresh track chunks, so the same song can be written any
+	number of times (or from several threads at once).  What's left
+	over from parsing - accidentals, ties - belongs to the Parser.
 	"""
 	def __init__(self):
-		self.events = []	# a list of events that defines the song
-		self.key = key.Key()	# create key object: stores, processes key info
 		self.track_count = 0	# number of tracks in this song 
 		self.track_list = []	# where the tracks live..
+		self.track_events = []	# ... and their events, an EventStore per track
+		self.ramp_spacing = 0	# fewest pulses between tempo/volume ramp steps (0: no limit)
+		self.ramp_curve = 'linear'	# shape of the ramps (see parse.RAMP_CURVES)
+		self.running_status = False	# leave out repeated status bytes
+		self.zero_note_offs = False	# note-offs as note-ons, velocity 0 (longer runs)
+
+	def add_track(self, track):
+		"""
+		A new track, and a new (empty) store of events for it
+		"""
+		self.track_events.append(EventStore(len(self.track_list)))
+		self.track_list.append(track)
+		self.track_count += 1
 
 	def append(self, event):
 		"""
-		Take an event, process as needed (notes) and append
-		to the event list
+		Append an event to the event store for its track.  Notes 
+		must already have their note_num (see Key.adjust); they're 
+		packed into the store's arrays and the Note object is let go: 
+		what comes back is a NoteView of the stored note (keep that if 
+		the note needs changing later - e.g. a tie).  Other events come 
+		back as is.
 		"""
-		if event.type == "NOTE" or event.type == "NOTEOFF":
-			self.key.adjust(event)	# take care of key / accidental adjustments
-		self.events += [ event ]
+		store = self.track_events[event.track_num]
+		if event.type == "NOTE":
+			return NoteView(store, store.add_note(NOTE_ON, event.pos, event.note_num, event.velocity))
+		if event.type == "NOTEOFF":
+			return NoteView(store, store.add_note(NOTE_OFF, event.pos, event.note_num, event.velocity))
+		store.add(event)
+		return event
 
-	def clear_ties(self):
-		for i in range(self.track_count):
-			track = self.track_list[i]
-			if track.tied:
-				print "Warning: unresolved tie."
-				track.tied = False
-			
-	def create_MFF(self, outfile, txt_file):
+	def rescale(self, ppq=None, time_factor=None):
+		"""
+		A copy of the song at a different PPQ and/or time correction
+		factor - no need to parse it again.  Positions are moved to the
+		new PPQ exactly where they can be (see scale), tempo events are
+		worked out again from their uncorrected values.  This song is 
+		left as it was, the copy shares nothing with it that changes.
+		"""
+		if ppq is None:
+			ppq = self.PPQ
+		if time_factor is None:
+			time_factor = self.time_factor
+		song = copy.copy(self)
+		song.PPQ = ppq
+		song.time_factor = time_factor
+		song.track_events = [ store.rescale(self.PPQ, ppq, time_factor) for store in self.track_events ]
+		return song
+
+	def sort_track(self, track_num):
+		"""
+		Put a track's events in time order - returns the store's 
+		row numbers in order.  The sort is stable (events at the same 
+		position stay in the order they were added) and takes advantage 
+		of the runs already in order.
+		"""
+		return self.track_events[track_num].order()
+
+	def all_events(self):
+		"""
+		Every event in the song in time order - each track
+		sorted, then merged.  Events at the same position come
+		in track order.
+		"""
+		tracks = []
+		for track_num in range(self.track_count):
+			store = self.track_events[track_num]
+			tracks.append([ (store.pos[row], track_num, n, row) for (n, row) in enumerate(store.order()) ])
+		for (pos, track_num, n, row) in heapq.merge(*tracks):
+			yield self.track_events[track_num].event(row)
+
+	def create_MFF(self, outfile, txt_file, profile=None, quiet=False):
 		""" 
 		Create a MIDI File Format file - based on the events
-	    	in the song object - output to previously opened file
+	    	in the song object - output to previously opened file.
+		With a profile (see profiling.py) the sort, emit and post
+		of each track are timed, and its length noted.  quiet: 
+		don't print the track count.
 		"""
 	
 		# We emit a header chunk and then one or more track chunks.
@@ -53,59 +145,307 @@ class Song:
 		#head.dump()	# debug output
 		head.post(outfile)	# output the header
 		
-		# 
-		# initialize a table of positions for each track,
-		# at the same time - create an event for each track 
-		# that sets the name
-		
-		track_pos = []
-		for i in range(self.track_count):
-			track_pos.append(0)		# where we are in each tack...
-			name_ev = Meta_Event()	# "generic"
-			name_ev.type = "TRACK NAME"
-			name_ev.event_type = 0x03	# sequence/track name
-			name_ev.data = self.track_list[i].name
-			name_ev.track_num = i
-			name_ev.pos = 0
-			self.append(name_ev)
-
-		self.events.sort(key=poskey)	# put the events in time order...
-
-		track_index = 0
-
-		for event in self.events:
-			track_index = event.track_num
-			diff = event.pos - track_pos[track_index]
-			if diff < 0:
-				print "Event / pos", event.pos, track_pos[track_index]
-			track = self.track_list[track_index]
-			track.append(MFF.vlq(diff))	# add the delta-time
-			event.emit(track)		# add the event...
-			track_pos[track_index]= event.pos
-		
-		print "Track count:", self.track_count
+		if not quiet:
+			print "Track count:", self.track_count
 		for track_num in range(self.track_count):
+			track = self.new_chunk(track_num)
+			# stream each track out as it's emitted (if outfile can seek)
+			track.begin(outfile)
+			if profile is None:
+				self.emit_track(track_num, track)
+			else:
+				with profile.phase('sort'):
+					rows = self.sort_track(track_num)
+				with profile.phase('emit'):
+					self.emit_track(track_num, track, rows)
 			#print "Ending track", track_num
-			self.track_list[track_num].end()
+			track.end()
 			#print "Posting track", track_num
-			#self.track_list[track_num].dump()
-			self.track_list[track_num].post(outfile)
+			#track.dump()
+			if profile is None:
+				track.post(outfile)
+			else:
+				profile.track(track.name, track.length())
+				with profile.phase('post'):
+					track.post(outfile)
+
+	def new_chunk(self, track_num):
+		"""
+		A fresh, empty chunk for a track to be emitted into
+		"""
+		track = MFF.Track_Chunk()
+		track.name = self.track_list[track_num].name
+		track.track_num = self.track_list[track_num].track_num
+		return track
 
+	def name_event(self, track_num):
+		"""
+		The event that sets the track's name
+		"""
+		name_ev = Meta_Event()	# "generic"
+		name_ev.type = "TRACK NAME"
+		name_ev.event_type = 0x03	# sequence/track name
+		name_ev.data = self.track_list[track_num].name
+		name_ev.track_num = track_num
+		name_ev.pos = 0
+		return name_ev
+
+
+	def emit_track(self, track_num, track=None, rows=None):
+		"""
+		Sort one track's events, and emit them (with their delta
+		times) into a chunk - a fresh one, unless one is passed in.
+		Tracks don't depend on each other, so they can be done in 
+		any order.  The track's name goes in after everything else at 
+		position 0 (where it always ended up when it was appended as 
+		an event).  Returns the chunk.  rows, if given, is the track 
+		already sorted (see sort_track).
+		"""
+		if track is None:
+			track = self.new_chunk(track_num)
+		pos = self.track_events[track_num].pos
+		if rows is None:
+			rows = self.sort_track(track_num)
+		start = 0
+		while start < len(rows) and pos[rows[start]] <= 0:
+			start += 1
+
+		last = self.emit_rows(track_num, track, rows[:start], 0)
+		track.append(MFF.vlq(0 - last))	# the name, at position 0
+		self.name_event(track_num).emit(track)
+		self.emit_rows(track_num, track, rows[start:], 0)
+		return track
+
+	def emit_rows(self, track_num, track, rows, last):
+		"""
+		Emit some of a track's rows (in the order given), last is
+		the position of the event before them.  Returns the position
+		of the last one.  The delta times are all encoded up front, 
+		in one pass (MFF.vlq_many).
+		"""
+		store = self.track_events[track_num]
+		running = self.running_status
+		track.running_status = running
+
+		# Notes go straight from the arrays - no objects needed
+		channel = track.track_num & 0x0f	# simulate MIDI channel, round-robin
+		status = [ 0x90 | channel, 0x80 | channel ]	# note on, note off
+		status_chr = [ chr(0x90 | channel), chr(0x80 | channel) ]
+		zero_offs = self.zero_note_offs
+		pos = store.pos
+		code = store.code
+		note_num = store.note_num
+		velocity = store.velocity
+		objects = store.objects
+
+		positions = map(pos.__getitem__, rows)
+		deltas = MFF.vlq_many(imap(operator.sub, positions, [ last ] + positions))
+		for (row, delta) in izip(rows, deltas):
+			c = code[row]
+			if c == OBJECT:
+				track.append(delta)	# add the delta-time
+				objects[row].emit(track)	# add the event...
+			else:
+				v = velocity[row]
+				if c == NOTE_OFF and zero_offs:
+					c = NOTE_ON
+					v = 0
+				if running and status[c] == track.status:
+					track.append(delta + chr(note_num[row]) + chr(v))
+				else:
+					track.append(delta + status_chr[c] + chr(note_num[row]) + chr(v))
+					track.status = status[c]
+		if positions:
+			last = positions[-1]
+		return last
 
 	def list(self,mask=[ 'All' ]):
 		""" list the events in time order
 		"""
-		self.events.sort(key=poskey)
 		#print "mask", mask
-		for e in self.events:
+		for e in self.all_events():
 			if "All" in mask:
 				return(e)
 			elif e.type in mask:
 				return(e)
-class Event:
+class EventStore:
+	"""
+	The events for one track.  Notes and note-offs are nearly all of 
+	any song, and an object (with its own dictionary) for each of them
+	was most of our memory.  So they're kept as rows of a few typed arrays
+	instead - position, what it is, note number and velocity: 18 bytes,
+	plus a slot in the objects list.
+
+	Anything else (tempo, volume, comments...) is rare enough to stay
+	an object; it goes in the objects list, which runs parallel to the
+	rows (None for the notes).  Its position is copied into the pos
+	array when it's added.
+	"""
+	def __init__(self, track_num=0):
+		self.track_num = track_num
+		self.pos = array('l')
+		self.code = array('B')		# NOTE_ON, NOTE_OFF or OBJECT
+		self.note_num = array('B')
+		self.velocity = array('B')
+		self.objects = []
+
+	def __len__(self):
+		return len(self.code)
+
+	def add_note(self, code, pos, note_num, velocity):
+		"""
+		A note on or off, returns its row
+		"""
+		self.pos.append(pos)
+		self.code.append(code)
+		self.note_num.append(note_num)
+		self.velocity.append(velocity)
+		self.objects.append(None)
+		return len(self.code) - 1
+
+	def add(self, event):
+		"""
+		Any other event, returns its row
+		"""
+		self.pos.append(event.pos)
+		self.code.append(OBJECT)
+		self.note_num.append(0)
+		self.velocity.append(0)
+		self.objects.append(event)
+		return len(self.code) - 1
+
+	def remove(self, rows):
+		"""
+		Take rows out of the store (rows: a set of row numbers).  The
+		rest keep their order, but not their row numbers - so any 
+		NoteViews taken out earlier are no good afterwards.
+		"""
+		if not rows:
+			return
+		keep = [ row for row in xrange(len(self.code)) if row not in rows ]
+		self.pos = array('l', [ self.pos[row] for row in keep ])
+		self.code = array('B', [ self.code[row] for row in keep ])
+		self.note_num = array('B', [ self.note_num[row] for row in keep ])
+		self.velocity = array('B', [ self.velocity[row] for row in keep ])
+		self.objects = [ self.objects[row] for row in keep ]
+
+	def rescale(self, old, new, time_factor):
+		"""
+		A copy of the store, positions moved from old PPQ to new.  The
+		objects are copied too (their positions change), tempo events
+		get the new time correction.
+		"""
+		store = EventStore(self.track_num)
+		store.code = array('B', self.code)
+		store.note_num = array('B', self.note_num)
+		store.velocity = array('B', self.velocity)
+		code = self.code
+		pos = self.pos
+		new_pos = store.pos
+		objects = store.objects
+		for row in xrange(len(code)):
+			c = code[row]
+			if c == NOTE_OFF:
+				new_pos.append(scale_off(pos[row], old, new))
+			else:
+				new_pos.append(scale(pos[row], old, new))
+			if c == OBJECT:
+				event = copy.copy(self.objects[row])
+				event.pos = new_pos[row]
+				if event.type == 'TEMPO':
+					event.t_val = int(event.base * time_factor)  # tempo correction for sync
+				objects.append(event)
+			else:
+				objects.append(None)
+		return store
+
+	def head(self, rows):
+		"""
+		A copy of the store's first rows (the objects aren't copied - 
+		they're shared)
+		"""
+		store = EventStore(self.track_num)
+		store.pos = self.pos[:rows]
+		store.code = self.code[:rows]
+		store.note_num = self.note_num[:rows]
+		store.velocity = self.velocity[:rows]
+		store.objects = self.objects[:rows]
+		return store
+
+	def extend(self, store, start):
+		"""
+		Add another store's rows, from start on, to the end of this one
+		"""
+		self.pos.extend(store.pos[start:])
+		self.code.extend(store.code[start:])
+		self.note_num.extend(store.note_num[start:])
+		self.velocity.extend(store.velocity[start:])
+		self.objects.extend(store.objects[start:])
+
+	def event(self, row):
+		"""
+		The event in a row: a view for notes, the object for anything else
+		"""
+		if self.code[row] == OBJECT:
+			return self.objects[row]
+		return NoteView(self, row)
+
+	def order(self):
+		"""
+		The rows, in time order (a stable sort on position)
+		"""
+		return sorted(xrange(len(self.code)), key=self.pos.__getitem__)
+
+class NoteView(object):
+	"""
+	A note or note-off that lives in an EventStore - just the store and
+	the row.  It looks enough like a Note for listing or emitting, and
+	changes (e.g. moving a tied note-off) go straight to the store.
+	"""
+	__slots__ = ('store', 'row')
+
+	def __init__(self, store, row):
+		self.store = store
+		self.row = row
+
+	def get_pos(self):
+		return self.store.pos[self.row]
+	def set_pos(self, pos):
+		self.store.pos[self.row] = pos
+	pos = property(get_pos, set_pos)
+
+	def get_type(self):
+		if self.store.code[self.row] == NOTE_ON:
+			return 'NOTE'
+		return 'NOTEOFF'
+	type = property(get_type)
+
+	def get_note_num(self):
+		return self.store.note_num[self.row]
+	note_num = property(get_note_num)
+
+	def get_velocity(self):
+		return self.store.velocity[self.row]
+	velocity = property(get_velocity)
+
+	def get_track_num(self):
+		return self.store.track_num
+	track_num = property(get_track_num)
+
+	def emit(self, track):
+		channel = track.track_num & 0x0f	# simulate MIDI channel, round-robin
+		cmd = (0x90, 0x80)[self.store.code[self.row]] | channel
+		track.message(cmd, chr(self.note_num) + chr(self.velocity))
+
+	def Info(self):	
+		print "Event: type, pos, track#", self.type, self.pos, self.track_num
+
+class Event(object):
 	"""
 	Base class for events.  At a minimum, a type, a position, and a track number
 	"""
+	__slots__ = ('type', 'pos', 'track_num')
+
 	def __init__(self):
 		self.type = "uninit"
 		self.pos = 0
@@ -118,7 +458,11 @@ class Event:
 class Note(Event):
 	"""
 	Defines a note, and a method for emitting it to the file...
+	Once added to a song it's stored as a row of an EventStore, this
+	object is just how the parser hands it over.
 	"""
+	__slots__ = ('dur', 'note', 'octave', 'key', 'velocity', 'note_num')
+
 	def __init__(self):
 		self.type = 'NOTE'
 		self.dur = 0
@@ -131,14 +475,14 @@ class Note(Event):
 		# note on is 0x90 
 		channel = track.track_num & 0x0f	# simulate MIDI channel, round-robin
 		cmd = 0x90 | channel
-		track.append(chr(cmd))
-		track.append(chr(self.note_num))
-		track.append(chr(self.velocity))
+		track.message(cmd, chr(self.note_num) + chr(self.velocity))
 
 class NoteOff(Event):
 	"""
 	Much like Note  but with a different command 
 	"""
+	__slots__ = ('note', 'octave', 'key', 'velocity', 'note_num')
+
 	def __init__(self):
 		self.type = 'NOTEOFF'
 		self.note = 0
@@ -148,9 +492,7 @@ class NoteOff(Event):
 		# note off is 0x80 or'd with MIDI channel
 		channel = track.track_num & 0x0f	# simulate MIDI channel, round-robin
 		cmd = 0x80 | channel
-		track.append(chr(cmd))
-		track.append(chr(self.note_num))
-		track.append(chr(self.velocity))
+		track.message(cmd, chr(self.note_num) + chr(self.velocity))
 
 class Volume(Event):
 	"""
@@ -164,9 +506,7 @@ class Volume(Event):
 		# MIDI Volume event - control change 7
 		channel = track.track_num & 0x0f	# simulate MIDI channel, round-robin
 		cmd = 0xB0 | channel		# control change
-		track.append(chr(cmd))
-		track.append(chr(7))	# '7' is the volume control change
-		track.append(chr(self.volume))
+		track.message(cmd, chr(7) + chr(self.volume))	# '7' is the volume control change
 		#print "Emitting Volume Event", self.volume, self.track_num, self.pos
 	
 class Meta_Event(Event):
@@ -179,16 +519,20 @@ class Meta_Event(Event):
 		self.data = "None"
 		self.track_num = 0
 		
-	def emit(self, track):
+	def emit(self, track, data=None):
 		""" 
-		Can be called by most child methods 
-		by filling in self.data as a string, setting self.type, 
-		then calling: Meta_Event.emit(self, track)
+		Can be called by most child methods with the data they've 
+		built as a string: Meta_Event.emit(self, track, data) - the
+		event itself isn't changed, so one song can be emitted from
+		several threads at once.  With no data, self.data is sent.
 		"""
+		if data is None:
+			data = self.data
+		track.no_status()		# meta events cancel running status
 		track.append(chr(0xff))		# all meta start with 0xff
 		track.append(chr(self.event_type))
-		track.append(MFF.vlq(len(self.data)))
-		track.append(self.data)
+		track.append(MFF.vlq(len(data)))
+		track.append(data)
 		
 class Comment(Meta_Event):
 	def __init__(self):
@@ -209,13 +553,14 @@ class Tempo(Meta_Event):
 		self.type = 'TEMPO'
 		self.event_type = 0x51	# Tempo event
 		self.t_val = 0			# a time value: microseconds per quarter note
+		self.base = 0			# ... before the time correction
 
 	def emit(self, track):
 		#print "Emitting Tempo Event", self.t_val, self.track_num, self.pos
 		# 
-		self.data = MFF.int2chars(self.t_val, 3) 	 # three byte value...
+		data = MFF.int2chars(self.t_val, 3) 	 # three byte value...
 		# call the parent class...
-		Meta_Event.emit(self, track)
+		Meta_Event.emit(self, track, data)
 
 class Time_Signature(Meta_Event):
 	def __init__(self):
@@ -227,8 +572,8 @@ class Time_Signature(Meta_Event):
 
 	def emit(self, track):
 		# Build up the fun bits of a tempo event...
-		self.data = chr(self.numerator) 	# start off easy...
-		self.ppq = 192
+		data = chr(self.numerator) 	# start off easy...
+		ppq = 192
 		#
 		# the next value is the log-base2 of the number
 		log = 0	# proposed value
@@ -244,22 +589,22 @@ class Time_Signature(Meta_Event):
 		if not valid:
 			print "Error: illegal denominator in time signature:", d, n, valid 
 			return
-		self.data += chr(log)
+		data += chr(log)
 		
 		# think that was tricky?  Now need to figure out how many pulses per "beat".
 		# if the numerator is evenly divisible by 3, and the denominator is 8 or better (not 
 		# sure I've ever seen 16) then divide by 2 (can't used dotted-quarter  3/2 of 192 is 
 		# greater than 256)
 		if self.numerator % 3 == 0 and d >= 8:
-			ppb = self.ppq / 2	# pulses per beat: eighth note
+			ppb = ppq / 2	# pulses per beat: eighth note
 		else:
-			ppb = self.ppq
+			ppb = ppq
 		
-		self.data += chr(ppb)	# pulses per beat
-		self.data += chr(8)		# notated 32nd notes per quarter
+		data += chr(ppb)	# pulses per beat
+		data += chr(8)		# notated 32nd notes per quarter
 		
 		#print "Time signature emit:", self.numerator, d, ppb 
-		Meta_Event.emit(self, track)
+		Meta_Event.emit(self, track, data)
 			
 class Key_Event(Meta_Event):	
 		def __init__(self):
@@ -271,10 +616,10 @@ class Key_Event(Meta_Event):
 			
 		def emit(self, track):
 			#print "Emitting key event", self.key, self.mode
-			self.data = chr(self.key & 0xff)	# range -7 - +7,  mask to 8 bits
-			self.data += chr(self.mode)
+			data = chr(self.key & 0xff)	# range -7 - +7,  mask to 8 bits
+			data += chr(self.mode)
 			
-			Meta_Event.emit(self, track)
+			Meta_Event.emit(self, track, data)
 """
 Debug code...
 """
@@ -282,6 +627,7 @@ def main():
 	print "Song test..."
 
 	song = Song()
+	song.add_track(MFF.Track_Chunk())
 
 	etype = 'COMMENT'
 	poslist = [ 9, 8, 7, 6, 5 ]
@@ -290,11 +636,10 @@ def main():
 			note = Event()
 			note.Info()
 			note.type = etype
-			note.note = n
 			note.pos = pos
 			note.Info()
 	
-			song.events += [ note ]
+			song.track_events[0].add(note)
 	
 			pos += 1
 
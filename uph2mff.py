@@ -13,15 +13,50 @@
 		songevents.py	Classes for the song and events
 		key.py			methods for handling the key adjustment of notes
 		MFF.py			classes specific to the MIDI File Format
+		optimize.py		optional pass to drop redundant events
+		cache.py		on-disk cache of converted files
+		incremental.py	re-parse just what an edit changed
+		parallel.py		parse one big score on several cores
+		profiling.py	where the time goes (--profile)
+
+	As a library: convert() takes the score (a string, buffer or open
+	file) and returns the MIDI file as a string, all in memory:
+		midi = uph2mff.convert(request_body, ppq=480)
+
+	Batch mode: any files, directories or glob patterns given after the
+	options are all converted, spread across a pool of worker processes
+	(-j), e.g.:
+		uph2mff.py -j 8 -d midi/ archive/ extras/*.uph
+
+	One big file can be parsed in pieces, split at barlines, on -j
+	cores (-P); the output is just the same:
+		uph2mff.py -P -j 4 -f huge.uph
+
+	--check just looks for problems - measure lengths, ties, anything
+	unrecognized - in the file or files, writing nothing, in a
+	fraction of the time a conversion takes.  The exit status is 1 if
+	there were any:
+		uph2mff.py --check archive/
 """
 
 import sys
+import os
+import io
+import glob
+import mmap
+import time
+import multiprocessing
 
 from optparse import OptionParser
 
 
 import parse
 import songevents
+import optimize
+import parallel
+import profiling
+import out_utils
+from cache import Cache
 
 
 #    a few utils...
@@ -34,6 +69,22 @@ def getoptions():
 		-t, --text text output, Division, Rank, and Orchestration data
 		-p, --ppq pulses per quarter note - default 192
 		-c, --correction   time correction factor
+		-j, --jobs	worker processes for batch mode (or -P) - default: one per CPU
+		-d, --outdir	batch mode output directory (else next to the input)
+		--ramp-rate	most tempo/volume ramp events per beat (quarter note)
+		--ramp-spacing	fewest pulses between ramp events
+		--ramp-curve	linear, exp, log or scurve
+		-O, --optimize	drop redundant tempo, volume, key and time signature events
+		-r, --running-status	leave out repeated status bytes
+		-z, --zero-note-offs	note-offs as note-ons with velocity 0 (with -r: longer runs)
+		-v, --variants	PPQ:factor,... - parse once, write a file for each
+		--cache	directory of already converted files (kept by content and options)
+		--cache-size	most the cache may hold, megabytes
+		-P, --parallel	parse a single file in pieces, on -j worker processes
+		--profile	time each phase, count events, commands and track bytes
+		-q, --quiet	don't print the parser's warnings (just how many there were)
+		--max-warnings	print at most N warnings of each kind - default 20 (-1: no limit)
+		--check	report the warnings in the file(s), convert nothing
 	"""
 	parser = OptionParser()
 	default="None"
@@ -53,9 +104,69 @@ def getoptions():
 	
 	parser.add_option("-c", "--correction", dest="time_correction_factor", action="store",
 	type="float", metavar="time_corr", help="Time correction: >1 is longer time, slower tempo", default=1)
+
+	parser.add_option("-j", "--jobs", dest="jobs", action="store",
+	type="int", metavar="N", help="batch mode: worker processes [one per CPU]", default=multiprocessing.cpu_count())
+
+	parser.add_option("-d", "--outdir", dest="outdir", action="store",
+	type="string", metavar="Directory", help="batch mode: output directory [next to input]", default=None)
+
+	parser.add_option("--ramp-rate", dest="ramp_rate", action="store",
+	type="int", metavar="N", help="at most N ramp events per beat [no limit]", default=0)
+
+	parser.add_option("--ramp-spacing", dest="ramp_spacing", action="store",
+	type="int", metavar="Pulses", help="at least this many pulses between ramp events [no limit]", default=0)
+
+	parser.add_option("--ramp-curve", dest="ramp_curve", action="store",
+	type="choice", choices=sorted(parse.RAMP_CURVES.keys()), metavar="Curve", 
+	help="shape of tempo/volume ramps: " + ", ".join(sorted(parse.RAMP_CURVES.keys())) + " [linear]", default="linear")
+	
+	parser.add_option("-O", "--optimize", dest="optimize", action="store_true",
+	help="drop redundant tempo, volume, key and time signature events", default=False)
+
+	parser.add_option("-r", "--running-status", dest="running_status", action="store_true",
+	help="use running status: leave out repeated status bytes", default=False)
+
+	parser.add_option("-z", "--zero-note-offs", dest="zero_note_offs", action="store_true",
+	help="write note-offs as note-ons with velocity 0", default=False)
+
+	parser.add_option("-v", "--variants", dest="variants", action="store",
+	type="string", metavar="PPQ:factor,...", 
+	help="write one file per PPQ/time correction pair, e.g. 192:1.0,480:1.1268 (factor defaults to -c)", default=None)
+
+	parser.add_option("--cache", dest="cache_dir", action="store",
+	type="string", metavar="Directory", help="reuse earlier conversions kept here [no cache]", default=None)
+
+	parser.add_option("--cache-size", dest="cache_size", action="store",
+	type="int", metavar="MB", help="most the cache may hold [256]", default=256)
+
+	parser.add_option("-P", "--parallel", dest="parallel", action="store_true",
+	help="parse one file in pieces on -j worker processes", default=False)
+
+	parser.add_option("--profile", dest="profile", action="store_true",
+	help="report time per phase, event and command counts, bytes per track", default=False)
+
+	parser.add_option("-q", "--quiet", dest="quiet", action="store_true",
+	help="don't print the parser's warnings, just count them", default=False)
+
+	parser.add_option("--max-warnings", dest="max_warnings", action="store",
+	type="int", metavar="N", help="print at most N warnings of each kind, -1 for all [%d]" % out_utils.MAX_PER_KIND,
+	default=out_utils.MAX_PER_KIND)
+
+	parser.add_option("--check", dest="check", action="store_true",
+	help="just check the file(s) for problems, write nothing", default=False)
 	
 	(options, args) = parser.parse_args()
 
+	if options.max_warnings < 0:
+		options.max_warnings = None	# no limit
+
+	if options.variants is not None:
+		try:
+			options.variants = parse_variants(options.variants, options.time_correction_factor)
+		except ValueError, info:
+			parser.error("bad --variants: %s" % info)
+
 
 	if options.filename == 'None':
 		print "Must specify a filename."
@@ -64,36 +175,421 @@ def getoptions():
 	return (options, args)
 
 
-def main():
+def parse_variants(text, time_factor):
 	"""
-	main: runstring options, parse the file to a song, output song to a file.
+	"192:1.0,480:1.1268" -> [ (192, 1.0), (480, 1.1268) ] - a 
+	PPQ with no factor gets the one given.
 	"""
-	
-	(options, args) = getoptions()
-	f_name=options.filename
-	out_name=options.outfilename
-	txt_name=options.textfilename
-	
+	variants = []
+	for item in text.split(','):
+		if ':' in item:
+			(ppq, factor) = item.split(':', 1)
+			factor = float(factor)
+		else:
+			(ppq, factor) = (item, time_factor)
+		ppq = int(ppq)
+		if ppq <= 0 or ppq > 0x7fff or factor <= 0:
+			raise ValueError(item)
+		variants.append((ppq, factor))
+	return variants
+
+def variant_name(out_name, ppq, factor):
+	"""
+	test.mid -> test-480-1.1268.mid
+	"""
+	(root, ext) = os.path.splitext(out_name)
+	return "%s-%d-%s%s" % (root, ppq, factor, ext or '.mid')
+
+def ramp_spacing(options):
+	"""
+	The fewest pulses between ramp events: the larger of
+	--ramp-spacing and what --ramp-rate works out to (at least a 
+	pulse: a rate over the PPQ mustn't turn the limit off)
+	"""
+	spacing = options.ramp_spacing
+	if options.ramp_rate > 0:
+		spacing = max(spacing, 1, options.PPQ / options.ramp_rate)
+	return spacing
 
-	# Set up a Song class - basically as list of events and a way to list them
+def new_song(ppq=192, time_factor=1, format=1, ramp_spacing=0, ramp_curve='linear',
+		running_status=False, zero_note_offs=False):
+	"""
+	Set up a Song class - basically as list of events and a way to list them
+	"""
 	song = songevents.Song()
-	song.format = 1		# RBF - set from run-string
-	song.PPQ = options.PPQ
+	song.format = format
+	song.PPQ = ppq
+	song.time_factor = time_factor	# stretch or shrink song length
+	song.ramp_spacing = ramp_spacing
+	song.ramp_curve = ramp_curve
+	song.running_status = running_status
+	song.zero_note_offs = zero_note_offs
+	return song
+
+def cache_settings(ppq, time_factor, format, ramp_spacing, ramp_curve,
+		optimize_events, running_status, zero_note_offs):
+	"""
+	Everything that changes the output, for the cache key
+	"""
+	return { 'ppq': ppq, 'time_factor': float(time_factor), 'format': format,
+		'ramp_spacing': ramp_spacing, 'ramp_curve': ramp_curve, 
+		'optimize': bool(optimize_events), 'running_status': bool(running_status),
+		'zero_note_offs': bool(zero_note_offs) }
+
+def variant_settings(settings, ppq, factor):
+	"""
+	... and for a variant (rescaled from what it was parsed at)
+	"""
+	if ppq is None:
+		return settings
+	return dict(settings, variant=(ppq, float(factor)))
+
+def convert(uph, ppq=192, time_factor=1, format=1, ramp_spacing=0, ramp_curve='linear',
+		optimize_events=False, running_status=False, zero_note_offs=False, cache=None,
+		diagnostics=None):
+	"""
+	The library entry point: convert a score to MIDI, all in memory.
+	uph is the score itself - a string, bytearray, memoryview - or
+	anything with a read() (an open file, a StringIO, a request body).
+	Returns the MIDI file as a string of bytes.  Nothing is read
+	from or written to the file system - unless a Cache is passed
+	in, which is checked first, and given the result after.
+	Nothing is printed: the parser's warnings are kept in diagnostics
+	(an out_utils.Diagnostics - pass one in to see them).
+	"""
+	data = parse.score_bytes(uph)
+	if cache is not None:
+		key = cache.key(data, cache_settings(ppq, time_factor, format, ramp_spacing,
+			ramp_curve, optimize_events, running_status, zero_note_offs))
+		midi = cache.get(key)
+		if midi is not None:
+			return midi
+
+	if diagnostics is None:
+		diagnostics = out_utils.Diagnostics(echo=False)
+	song = new_song(ppq, time_factor, format, ramp_spacing, ramp_curve,
+		running_status, zero_note_offs)
+	parse.parse_text(parse.read_score(data), song, diagnostics=diagnostics, quiet=True)
+
+	if optimize_events:
+		optimize.optimize_song(song)
+
+	outfile = io.BytesIO()
+	song.create_MFF(outfile, None, quiet=True)
+	midi = outfile.getvalue()
+	if cache is not None:
+		cache.put(key, midi)
+	return midi
+
+def write_midi(name, midi):
+	outfile = open(name, 'wb')
+	outfile.write(midi)
+	outfile.close()
+
+def convert_file(f_name, out_name, txt_name, options, cache=None, profile=None):
+	"""
+	parse one file to a song, output the song to a MIDI file (or a
+	file per variant).  With a cache, anything it already has is 
+	copied straight out.  Returns True if nothing needed converting.
+	A profile (profiling.Profile) is filled in as we go.  The parser's
+	warnings are printed as -q and --max-warnings say.
+	"""
+	timer = profile or profiling.NO_PROFILE
+	diagnostics = out_utils.Diagnostics(echo=not getattr(options, 'quiet', False),
+		max_per_kind=getattr(options, 'max_warnings', out_utils.MAX_PER_KIND))
+	spacing = ramp_spacing(options)
+	if options.variants:
+		outputs = [ (variant_name(out_name, ppq, factor), ppq, factor) for (ppq, factor) in options.variants ]
+	else:
+		outputs = [ (out_name, None, None) ]
+
+	data = None
+	keys = {}	# output name -> cache key, for the ones to add to the cache
+	if cache is not None:
+		with timer.phase('read'):
+			infile = open(f_name, 'rb')
+			data = infile.read()
+			infile.close()
+		settings = cache_settings(options.PPQ, options.time_correction_factor, 1, spacing, 
+			options.ramp_curve, options.optimize, options.running_status, options.zero_note_offs)
+		todo = []
+		for (name, ppq, factor) in outputs:
+			key = cache.key(data, variant_settings(settings, ppq, factor))
+			midi = cache.get(key)
+			if midi is None:
+				keys[name] = key
+				todo.append((name, ppq, factor))
+			else:
+				print "From cache:", name
+				write_midi(name, midi)
+		if not todo:
+			return True
+		outputs = todo
+
+	song = new_song(options.PPQ, options.time_correction_factor, 1,	# RBF - format from run-string
+		spacing, options.ramp_curve,
+		options.running_status, options.zero_note_offs)
 	print "PPQ:", song.PPQ
-	song.time_factor = options.time_correction_factor # stretch or shrink song length
 	print "Song.tf", song.time_factor
 
 	# parse the song into a list of events
-	parse.parse_song(f_name, song)
+	if getattr(options, 'parallel', False) and options.jobs > 1:
+		with timer.phase('read'):
+			if data is None:
+				infile = open(f_name, 'rb')
+				text = parse.map_score(infile)
+				infile.close()
+			else:
+				text = parse.read_score(data)
+		try:
+			with timer.phase('parse'):
+				parallel.parse_parallel(text, song, options.jobs, diagnostics=diagnostics)
+		finally:
+			if isinstance(text, mmap.mmap):
+				text.close()
+	elif data is None:
+		with timer.phase('parse'):	# (reading the file as it goes)
+			parse.parse_song(f_name, song, profile, diagnostics)
+	else:
+		with timer.phase('parse'):
+			parse.parse_text(parse.read_score(data), song, profile, diagnostics)
+	diagnostics.summary()
+
+	if options.optimize:
+		with timer.phase('optimize'):
+			optimize.report(optimize.optimize_song(song))
+	if profile is not None:
+		profile.count_events(song)
 
 	#song.list()	# debug...
 
-	# for testing.  Later:  use option passed file
-	#outfile = open('testout.mid','wb')
-	outfile = open(out_name, 'wb')
-	song.create_MFF(outfile,txt_name)	# create a MIDI file, and optionally, a text summary
+	for (name, ppq, factor) in outputs:
+		if profile is not None:
+			profile.output = name
+		if ppq is None:
+			rendered = song
+		else:	# one parse, many outputs
+			print "Writing", name
+			with timer.phase('rescale'):
+				rendered = song.rescale(ppq, factor)
+		if name in keys:	# keep a copy for the cache
+			outfile = io.BytesIO()
+			rendered.create_MFF(outfile, txt_name, profile)
+			midi = outfile.getvalue()
+			write_midi(name, midi)
+			cache.put(keys[name], midi)
+		else:
+			outfile = open(name, 'wb')
+			rendered.create_MFF(outfile,txt_name, profile)	# create a MIDI file, and optionally, a text summary
+			outfile.close()
+	return False
 
-	outfile.close()
+CACHES = {}	# this process's cache for each directory
+
+def open_cache(options):
+	"""
+	The cache asked for on the runstring, if any
+	"""
+	if options.cache_dir is None:
+		return None
+	if options.cache_dir not in CACHES:
+		CACHES[options.cache_dir] = Cache(options.cache_dir, options.cache_size * 1024 * 1024)
+	return CACHES[options.cache_dir]
+
+#
+# Batch mode...
+#
+def find_scores(args):
+	"""
+	Expand the runstring arguments: directories are searched (all the 
+	way down) for .uph files, anything else is treated as a glob pattern
+	(a plain file name is just a pattern that matches itself).  
+	Returns a list of (base directory, file name) tuples - the base is
+	used to mirror the directory layout under the output directory.
+	"""
+	scores = []
+	for arg in args:
+		if os.path.isdir(arg):
+			for (dirpath, dirnames, filenames) in os.walk(arg):
+				dirnames.sort()
+				for name in sorted(filenames):
+					if name.lower().endswith('.uph'):
+						scores.append((arg, os.path.join(dirpath, name)))
+		else:
+			matches = sorted(glob.glob(arg))
+			if not matches:
+				print "Warning: nothing matches", arg
+			for name in matches:
+				scores.append((os.path.dirname(name), name))
+	return scores
+
+def output_name(base, f_name, outdir):
+	"""
+	.uph -> .mid, either next to the input, or in the same place
+	relative to the output directory.
+	"""
+	out_name = os.path.splitext(f_name)[0] + '.mid'
+	if outdir is None:
+		return out_name
+	out_name = os.path.join(outdir, os.path.relpath(out_name, base or '.'))
+	out_dir = os.path.dirname(out_name)
+	if out_dir and not os.path.isdir(out_dir):
+		try:
+			os.makedirs(out_dir)
+		except OSError:		# another worker beat us to it
+			if not os.path.isdir(out_dir):
+				raise
+	return out_name
+
+def batch_worker(job):
+	"""
+	Convert one file in a worker process.  Any failure is returned,
+	not raised, so one bad file doesn't stop the run.  The parser's
+	chatter is thrown away - with many workers it's just noise.
+	Returns (input, output, seconds, CPU seconds, error or None, 
+	True if it all came from the cache)
+	"""
+	(base, f_name, options) = job
+	start = time.time()
+	cpu = time.clock()
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		try:
+			out_name = output_name(base, f_name, options.outdir)
+			cached = convert_file(f_name, out_name, None, options, open_cache(options))
+		except Exception, info:
+			return (f_name, None, time.time() - start, time.clock() - cpu,
+				"%s: %s" % (info.__class__.__name__, info), False)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+	return (f_name, out_name, time.time() - start, time.clock() - cpu, None, cached)
+
+def batch_convert(scores, options):
+	"""
+	Convert a list of scores across a pool of worker processes,
+	reporting each one as it finishes.  Returns the number of failures.
+	"""
+	jobs = [ (base, f_name, options) for (base, f_name) in scores ]
+	workers = max(1, min(options.jobs, len(jobs)))
+	print "Converting", len(jobs), "files with", workers, "worker(s)"
+
+	start = time.time()
+	if workers == 1:
+		results = (batch_worker(job) for job in jobs)
+	else:
+		pool = multiprocessing.Pool(workers)
+		results = pool.imap_unordered(batch_worker, jobs)
+
+	busy = 0.0	# total CPU time spent converting, all workers
+	failed = 0
+	hits = 0
+	for (f_name, out_name, seconds, cpu, error, cached) in results:
+		busy += cpu
+		if cached:
+			hits += 1
+			print "%8.3fs  %s -> %s (cached)" % (seconds, f_name, out_name)
+		elif error is None:
+			print "%8.3fs  %s -> %s" % (seconds, f_name, out_name)
+		else:
+			failed += 1
+			print "%8.3fs  %s FAILED: %s" % (seconds, f_name, error)
+
+	if workers > 1:
+		pool.close()
+		pool.join()
+	elapsed = time.time() - start
+	print "%d converted, %d failed, %.3f seconds (%.3f CPU seconds converting, %.1fx)" % (
+		len(jobs) - failed, failed, elapsed, busy, busy / elapsed if elapsed else 0)
+	if options.cache_dir is not None:
+		print "Cache: %d of %d from the cache" % (hits, len(jobs))
+	return failed
+
+#
+# Check mode...
+#
+def check_worker(job):
+	"""
+	Lint one file (in a worker process, for more than one) at the 
+	PPQ given.  Returns (file name, the Diagnostics or None, error
+	or None)
+	"""
+	(f_name, ppq) = job
+	try:
+		return (f_name, parse.lint(f_name, ppq=ppq), None)
+	except Exception, info:		# (one bad file mustn't stop the rest)
+		return (f_name, None, "%s: %s" % (info.__class__.__name__, info))
+
+def check_scores(f_names, options):
+	"""
+	Report what's wrong with each score, in order: each warning with
+	where it is, as many as -q and --max-warnings allow, then a count.
+	Returns the number of files with problems (or that couldn't be read).
+	"""
+	jobs = [ (f_name, options.PPQ) for f_name in f_names ]
+	workers = max(1, min(options.jobs, len(jobs)))
+	if workers == 1:
+		results = (check_worker(job) for job in jobs)
+	else:
+		pool = multiprocessing.Pool(workers)
+		results = pool.imap(check_worker, jobs)
+
+	bad = 0
+	for (f_name, diagnostics, error) in results:
+		if error is not None:
+			bad += 1
+			print "%s: FAILED: %s" % (f_name, error)
+			continue
+		if not diagnostics.total:
+			continue
+		bad += 1
+		shown = {}	# kind -> how many printed
+		for warning in diagnostics.warnings:
+			shown[warning.kind] = shown.get(warning.kind, 0) + 1
+			if options.quiet or (options.max_warnings is not None and 
+					shown[warning.kind] > options.max_warnings):
+				continue
+			print "%s: measure %d, offset %d: %s" % (f_name, warning.measure, warning.offset, warning.kind)
+			print warning.text()
+		print "%s: %d warning(s) (%s)" % (f_name, diagnostics.total,
+			", ".join([ "%s: %d" % (kind, n) for (kind, n) in sorted(diagnostics.counts.items()) ]))
+
+	if workers > 1:
+		pool.close()
+		pool.join()
+	print "%d checked, %d with problems" % (len(f_names), bad)
+	return bad
+
+def main():
+	"""
+	main: runstring options, parse the file to a song, output song to a file.
+	With files or directories on the runstring: batch convert them all.
+	"""
+	
+	(options, args) = getoptions()
+
+	if options.check:
+		if args:
+			f_names = [ f_name for (base, f_name) in find_scores(args) ]
+		else:
+			f_names = [ options.filename ]
+		sys.exit(1 if check_scores(f_names, options) else 0)
+
+	if args:
+		options.parallel = False	# the files are already spread across the workers
+		options.profile = False		# (and their output isn't shown)
+		options.quiet = True
+		failed = batch_convert(find_scores(args), options)
+		sys.exit(1 if failed else 0)
+
+	cache = open_cache(options)
+	profile = profiling.Profile() if options.profile else None
+	convert_file(options.filename, options.outfilename, options.textfilename, options, cache, profile)
+	if cache is not None:
+		cache.report()
+	if profile is not None:
+		profile.report()
 	
 	print "All done."
 